@@ -1,5 +1,6 @@
 import pandas as pd
 import numpy as np
+from output_parser import validate_and_clean_triplets
 
 def process_recombination_data(recomb_stats_path, sim_compare_path):
     """
@@ -63,39 +64,6 @@ def save_processed_data(processed_df, output_path):
     """
     processed_df.to_csv(output_path, index=False)
 
-def validate_and_clean_triplets(processed_df):
-    """
-    Validate triplets and remove those with more than one recombinant.
-    
-    Parameters:
-    processed_df (pandas.DataFrame): The processed DataFrame
-    
-    Returns:
-    pandas.DataFrame: Cleaned DataFrame with invalid triplets removed
-    dict: Statistics about the cleaning process
-    """
-    rows_to_keep = []
-    stats = {
-        'original_triplets': len(processed_df) // 3,
-        'removed_triplets': 0,
-        'remaining_triplets': 0
-    }
-    
-    for i in range(0, len(processed_df), 3):
-        triplet = processed_df.iloc[i:i+3]
-        recomb_count = triplet['is_recombinant'].sum()
-        
-        if recomb_count == 1:
-            rows_to_keep.extend([i, i+1, i+2])
-        else:
-            stats['removed_triplets'] += 1
-            print(f"Removing triplet at rows {i}-{i+2}: {recomb_count} recombinants found")
-    
-    cleaned_df = processed_df.iloc[rows_to_keep].copy()
-    stats['remaining_triplets'] = len(cleaned_df) // 3
-    
-    return cleaned_df, stats
-
 if __name__ == '__main__':
     recomb_stats_path = 'dataRaw/UnseenTestSet/alignment_TestSet_2022-08-20-15_55_16_3300-0.07-0.000114-100.faRecombIdentifyStats.csv'
     sim_compare_path = 'dataRaw/UnseenTestSet/alignment_TestSet_2022-08-20-15_55_16_3300-0.07-0.000114-100.faSimVSRealCompare.csv'
@@ -0,0 +1,180 @@
+# Benchmarks the classifier and the parsers on synthetic SANTA-SIM-like data, see synthetic_data.py.
+# Every stage of the classifier is timed through classifier_metrics, as are the output_parser and tools transforms.
+# The outputs of each preset scale are hashed and checked against benchmark_golden.json, so a faster implementation
+# that changes a result fails the run. With the numba backend the compiled kernels are also checked against the NumPy ones
+# on random inputs first, see check_kernels.
+# e.g. python benchmark.py -s tiny small -n 3
+#      python benchmark.py -s medium -j results.json      (keeps the timings to compare against later runs)
+#      python benchmark.py -b numba                        (the compiled kernels, their results must match too)
+#      python benchmark.py --update-golden                 (after a change that is meant to alter the outputs)
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import sys
+import tempfile
+from pathlib import Path
+import numpy as np
+import event_classifier
+import classifier_kernels
+import classifier_metrics
+import output_parser
+import synthetic_data
+import tools
+
+GOLDEN_PATH = Path(__file__).with_name('benchmark_golden.json')
+
+# sequences, genome length, events and gap density of the simulated alignment, triplets of the simulated RDP output
+SCALES = {
+    'tiny': dict(sequences=40, genome_length=2000, events=15, gap_density=0.01, triplets=300),
+    'small': dict(sequences=100, genome_length=5000, events=40, gap_density=0.01, triplets=3000),
+    'medium': dict(sequences=300, genome_length=10000, events=120, gap_density=0.02, triplets=30000),
+    'large': dict(sequences=1000, genome_length=30000, events=400, gap_density=0.02, triplets=300000),
+}
+
+def digest(data):
+    # sha256 of bytes, or of the CSV text of a DataFrame
+    if not isinstance(data, bytes):
+        data = data.to_csv(index=False).encode()
+    return hashlib.sha256(data).hexdigest()
+
+def run_once(folder, scale, seed=0, eventWorkers=1, backend='numpy'):
+    # Generates the fixtures of one scale in folder, runs every stage once
+    # returns (metrics record, digests of the outputs)
+    key = 'bench-' + '-'.join(str(v) for v in scale.values())
+    alignment, rec_events, seq_events = synthetic_data.simulate(scale['sequences'], scale['genome_length'], scale['events'],
+                                                                scale['gap_density'], seed)
+    alig, rec, seq = synthetic_data.write_santa_files(folder, key, alignment, rec_events, seq_events)
+    stats, compare = synthetic_data.write_rdp_files(folder, key, scale['triplets'], scale['sequences'], seed=seed)
+    digests = {}
+
+    parse = event_classifier.classifier(alig, rec, seq, outputDir=folder / 'output', eventWorkers=eventWorkers, metrics=True,
+                                         backend=backend)
+    with contextlib.redirect_stdout(io.StringIO()):
+        filePath = parse.output()
+    digests['classifier'] = digest(filePath.read_bytes())
+    metrics = parse.metrics
+
+    # the parsers print a line per dropped triplet and the triplet balancing prints its tables, so their output is kept quiet
+    with contextlib.redirect_stdout(io.StringIO()):
+        with metrics.stage('process_recombination_data'):
+            processed = output_parser.process_recombination_data(stats, compare)
+        digests['process_recombination_data'] = digest(processed)
+
+        with metrics.stage('validate_and_clean_triplets'):
+            cleaned, _ = output_parser.validate_and_clean_triplets(processed, (stats, compare))
+        cleaned = cleaned.drop(columns=['ISeqs(A)'])
+        digests['validate_and_clean_triplets'] = digest(cleaned)
+
+        with metrics.stage('combine_three_rows'):
+            combined = tools.combine_three_rows(cleaned, folder / 'combined.csv')
+        digests['combine_three_rows'] = digest(combined)
+
+        cleaned.to_csv(folder / 'cleaned.csv', index=False)
+        with metrics.stage('balance_triplet_positions'):
+            balanced = tools.balance_triplet_positions(folder / 'cleaned.csv', random_seed=42)
+        digests['balance_triplet_positions'] = digest(balanced)
+
+    return parse.metricsRecord(), digests
+
+def check_kernels(backend, trials=200, seed=0):
+    # Runs the kernels of a backend and the NumPy reference kernels on the same random inputs
+    # the inputs cover gaps, deleted positions, empty and overlapping regions, tied pair scores and no accepted pair
+    # returns the number of cases that differ
+    rng = np.random.default_rng(seed)
+    hamming, pair = event_classifier.kernels(backend)
+    reference_hamming, reference_pair = event_classifier.kernels('numpy')
+    failures = 0
+    for _ in range(trials):
+        length = int(rng.integers(1, 400))
+        parents = int(rng.integers(1, 40))
+        alignment = rng.choice(np.frombuffer(b'ACGT-', dtype=np.uint8), size=(parents + 1, length))
+        excluded = (alignment[1:] == synthetic_data.GAP) | (rng.random((parents, length)) < rng.random() / 4)
+        regions = []
+        for _ in range(4):
+            intervals = min(int(rng.integers(0, 4)), (length + 1) // 2)
+            edges = np.sort(rng.choice(length + 1, size=2 * intervals, replace=False))
+            regions.append((edges[0::2], edges[1::2]))
+        args = (alignment[0], alignment[0] == synthetic_data.GAP, alignment[1:], excluded, regions)
+        failures += any(not np.array_equal(a, b) for a, b in zip(hamming(*args), reference_hamming(*args)))
+
+        # scores on a coarse grid so that ties happen, and high enough now and then that no pair is accepted
+        sum1 = rng.integers(0, 9, size=parents) / 4
+        sum2 = rng.integers(0, 9, size=parents) / 4 + (1 if rng.random() < 0.2 else 0)
+        failures += pair(sum1, sum2) != reference_pair(sum1, sum2)
+    return failures
+
+def best_of(records):
+    # The fastest of repeated runs of every stage, the counters are the same in every run
+    best = dict(records[0], stages={})
+    for record in records:
+        for name, entry in record['stages'].items():
+            if name not in best['stages'] or entry['wall'] < best['stages'][name]['wall']:
+                best['stages'][name] = entry
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the classifier and parsers on synthetic data")
+    parser.add_argument("-s", dest="scales", nargs='+', default=['tiny', 'small'], choices=SCALES, help="preset scales to run")
+    parser.add_argument("-n", dest="repeats", type=int, default=1, help="runs per scale, the fastest time of each stage is kept")
+    parser.add_argument("-w", dest="workers", type=int, default=1, help="event workers of the classifier")
+    parser.add_argument("-b", dest="backend", type=str, default="numpy", choices=classifier_kernels.BACKENDS, help="kernels of the classifier")
+    parser.add_argument("-j", dest="json_path", type=str, default=None, help="file the timings are written to as JSON")
+    parser.add_argument("--sequences", type=int, help="override the number of sequences of every scale")
+    parser.add_argument("--genome-length", type=int, help="override the genome length of every scale")
+    parser.add_argument("--events", type=int, help="override the number of recombination events of every scale")
+    parser.add_argument("--gap-density", type=float, help="override the gap density of every scale")
+    parser.add_argument("--triplets", type=int, help="override the number of RDP triplets of every scale")
+    parser.add_argument("--update-golden", action="store_true", help="store the outputs of the preset scales as the golden result")
+    args = parser.parse_args()
+
+    overrides = {k: v for k, v in vars(args).items() if k in SCALES['tiny'] and v is not None}
+    golden = json.loads(GOLDEN_PATH.read_text()) if GOLDEN_PATH.exists() else {}
+    results = {}
+    mismatches = []
+
+    backend = classifier_kernels.resolve(args.backend)
+    if backend != 'numpy':
+        failures = check_kernels(backend)
+        print(f'kernels: {backend} ' + (f'differs from numpy in {failures} cases' if failures else 'matches numpy'))
+        if failures:
+            mismatches.append(f'kernels/{backend}')
+
+    for name in args.scales:
+        scale = dict(SCALES[name], **overrides)
+        records = []
+        with tempfile.TemporaryDirectory() as folder:
+            for _ in range(args.repeats):
+                record, digests = run_once(Path(folder), scale, eventWorkers=args.workers, backend=backend)
+                records.append(record)
+
+        record = best_of(records)
+        results[name] = {'scale': scale, 'record': record, 'digests': digests}
+        print(f"\n{name}: {scale}")
+        print(classifier_metrics.format_summary(classifier_metrics.summarise([record])))
+
+        # only the preset parameters have a golden result
+        if overrides:
+            continue
+        if args.update_golden:
+            golden[name] = digests
+        elif name in golden:
+            changed = [stage for stage, value in digests.items() if golden[name].get(stage) != value]
+            mismatches += [f'{name}/{stage}' for stage in changed]
+            print('golden: ' + (f"changed outputs from {', '.join(changed)}" if changed else 'all outputs match'))
+
+    if args.update_golden:
+        GOLDEN_PATH.write_text(json.dumps(golden, indent=2, sort_keys=True) + '\n')
+        print(f'\nGolden results written to {GOLDEN_PATH.name}')
+    if args.json_path is not None:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if mismatches:
+        print('\nOutputs differ from the golden result: ' + ', '.join(mismatches))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
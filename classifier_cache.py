@@ -0,0 +1,80 @@
+# On-disk cache of the preprocessed inputs of event_classifier.classifier.
+# An entry holds everything the classifier builds before parent calling: the alignment matrix, the event arrays,
+# the generation matrix and its run-length block map. Entries are keyed by a hash of the contents of the three input files,
+# so editing or regenerating any of them misses the cache and the stale entry is replaced on the next save.
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+
+# Bump when the layout of an entry changes, older entries then no longer match any key
+CACHE_VERSION = 1
+
+# Default folder for the entries, created next to the alignment file
+CACHE_FOLDER = 'classifier_cache'
+
+# Large matrices get their own .npy so they can be memory-mapped, the rest go in one .npz
+MATRICES = ('alignment', 'generationMatrix')
+ARRAYS = 'arrays.npz'
+
+def input_key(*paths, chunk=1 << 20):
+    # sha256 over the bytes of the input files (in the given order) and CACHE_VERSION, as a hex string
+    digest = hashlib.sha256(str(CACHE_VERSION).encode())
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(chunk), b''):
+                digest.update(block)
+        # keeps ('ab', 'c') and ('a', 'bc') apart
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def entry_path(folder, name, key):
+    # Entry of one alignment, name is the alignment file stem
+    return Path(folder) / (name + '.' + key[:32])
+
+def load(folder, name, key, mmap_mode='r'):
+    # Returns the dict of arrays stored for (name, key), or None on a miss
+    # the matrices are memory-mapped with mmap_mode (None reads them into RAM)
+    entry = entry_path(folder, name, key)
+    if not (entry / ARRAYS).exists():
+        return None
+
+    with np.load(entry / ARRAYS) as stored:
+        arrays = {k: stored[k] for k in stored.files}
+    for matrix in MATRICES:
+        arrays[matrix] = np.load(entry / (matrix + '.npy'), mmap_mode=mmap_mode)
+
+    return arrays
+
+def save(folder, name, key, arrays):
+    # Stores a dict of arrays under (name, key) and removes the older entries of the same alignment
+    # the entry is written to a temporary folder and renamed into place, so a reader never sees half an entry
+    # and of two workers saving the same entry at once, the second one just drops its copy
+    folder = Path(folder)
+    os.makedirs(folder, exist_ok=True)
+    entry = entry_path(folder, name, key)
+    temp = folder / (entry.name + '.tmp' + str(os.getpid()))
+
+    os.makedirs(temp, exist_ok=True)
+    try:
+        for matrix in MATRICES:
+            np.save(temp / (matrix + '.npy'), arrays[matrix])
+        # arrays.npz is written last, load() treats an entry without it as missing
+        np.savez(temp / ARRAYS, **{k: v for k, v in arrays.items() if k not in MATRICES})
+        os.replace(temp, entry)
+    except OSError:
+        if not (entry / ARRAYS).exists():
+            raise
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+
+    # older entries are <name>.<32 hex digits>, temporary folders of other workers don't match
+    for stale in folder.iterdir():
+        digits = stale.name[len(name)+1:]
+        if (stale != entry and stale.name.startswith(name + '.') and len(digits) == 32
+                and all(c in '0123456789abcdef' for c in digits)):
+            shutil.rmtree(stale, ignore_errors=True)
+
+    return entry
@@ -0,0 +1,81 @@
+# Optional compiled kernels for the hot loops of event_classifier.classifier.
+# With numba installed, the gap-aware Hamming counts and the search for the best parent pair are JIT-compiled loops over
+# the typed arrays: one pass per parent with no [parents x genome length] temporaries, and a pair scan with no
+# [minor x major] matrix. The NumPy versions in event_classifier (hamming_counts, best_pair) are the reference and the
+# fallback. Both backends give identical results, see check_kernels in benchmark.py.
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# auto runs numba when it is installed and NumPy otherwise
+BACKENDS = ('auto', 'numpy', 'numba')
+
+def resolve(backend='auto'):
+    # The backend that will run for a requested one
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+    if backend == 'auto':
+        return 'numpy' if numba is None else 'numba'
+    if backend == 'numba' and numba is None:
+        raise ImportError("The numba backend needs numba, e.g. pip install numba")
+    return backend
+
+if numba is not None:
+
+    @numba.njit(cache=True, nogil=True)
+    def region_counts(recombinant, recombinant_gaps, parents, parent_gaps, starts, ends, owners, n_regions):
+        # Counts every interval [starts[i], ends[i]) into region owners[i], for every parent
+        # the gap masks come as uint8 and every interval is sliced out first, so the inner loop is a branch-free
+        # loop from 0 that LLVM vectorises
+        # returns (mismatches, sites), both [regions x parents] int64
+        mismatches = np.zeros((n_regions, parents.shape[0]), dtype=np.int64)
+        sites = np.zeros((n_regions, parents.shape[0]), dtype=np.int64)
+        for p in range(parents.shape[0]):
+            for i in range(len(starts)):
+                start, end = starts[i], ends[i]
+                parent, parent_gap = parents[p, start:end], parent_gaps[p, start:end]
+                nucleotides, gaps = recombinant[start:end], recombinant_gaps[start:end]
+                differing = 0
+                compared = 0
+                for j in range(end - start):
+                    both = 1 - (parent_gap[j] | gaps[j])
+                    compared += both
+                    differing += both & (parent[j] != nucleotides[j])
+                mismatches[owners[i], p] += differing
+                sites[owners[i], p] += compared
+        return mismatches, sites
+
+    @numba.njit(cache=True, nogil=True)
+    def pair_scan(sum1, sum2):
+        # The accepted pair with the lowest score, the first one in row-major order on ties like np.argmin
+        # returns (minor, major, score), (-1, -1, inf) when no pair is accepted
+        best = np.inf
+        best_minor = -1
+        best_major = -1
+        for minor in range(len(sum1)):
+            minor_evidence = sum1[minor] < 0.75
+            for major in range(len(sum2)):
+                score = sum1[minor] + sum2[major]
+                if score < best and (score < 1.99 or minor_evidence or sum2[major] < 0.75):
+                    best = score
+                    best_minor = minor
+                    best_major = major
+        return best_minor, best_major, best
+
+def hamming_counts(recombinant, recombinant_gaps, parents, parent_gaps, regions):
+    # Compiled event_classifier.hamming_counts, same arguments and results
+    parents = np.atleast_2d(parents)
+    parent_gaps = np.atleast_2d(parent_gaps)
+    starts = np.concatenate([np.asarray(starts, dtype=np.int64) for starts, _ in regions] + [np.empty(0, dtype=np.int64)])
+    ends = np.concatenate([np.asarray(ends, dtype=np.int64) for _, ends in regions] + [np.empty(0, dtype=np.int64)])
+    owners = np.repeat(np.arange(len(regions), dtype=np.int64), [len(region_starts) for region_starts, _ in regions])
+    return region_counts(recombinant, recombinant_gaps.view(np.uint8), parents, parent_gaps.view(np.uint8), starts, ends, owners, len(regions))
+
+def best_pair(sum1, sum2):
+    # Compiled event_classifier.best_pair, same arguments and results
+    minor, major, score = pair_scan(np.asarray(sum1, dtype=np.float64), np.asarray(sum2, dtype=np.float64))
+    return (int(minor), int(major), float(score)) if minor >= 0 else None
@@ -0,0 +1,77 @@
+# Persistent record of a classifier batch, kept as SQLite in the output folder.
+# Every alignment gets one row with its status, the hash of its input files, the attempts made,
+# the wall time and peak RSS growth of the last attempt and the error it failed with, so a restarted batch
+# can skip what is done and retry what failed.
+
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+MANIFEST_NAME = 'classifier_manifest.sqlite'
+
+# Status of an alignment: running is written when it is handed to a worker, a run that was killed stays running
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS alignments (
+    alignment TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    input_stamp TEXT,
+    input_hash TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    wall_time REAL,
+    peak_rss_mb REAL,
+    error TEXT,
+    updated REAL
+)
+'''
+
+def input_stamp(*paths):
+    # Size and modification time of the input files, a cheap check of whether they changed since the hash was taken
+    return ';'.join(f'{os.stat(path).st_size}:{os.stat(path).st_mtime_ns}' for path in paths)
+
+class Manifest:
+
+    def __init__(self, path):
+        # Opens or creates the manifest, only the process running the batch writes to it
+        self.path = Path(path)
+        os.makedirs(self.path.parent, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def get(self, alignment):
+        # The row of an alignment as a sqlite3.Row, or None if it was never scheduled
+        return self.db.execute('SELECT * FROM alignments WHERE alignment = ?', (str(alignment),)).fetchone()
+
+    def start(self, alignment):
+        # Marks an alignment as running and counts the attempt
+        self.db.execute('''INSERT INTO alignments (alignment, status, attempts, updated) VALUES (?, ?, 1, ?)
+                           ON CONFLICT (alignment) DO UPDATE SET status = excluded.status, attempts = attempts + 1,
+                           error = NULL, updated = excluded.updated''', (str(alignment), RUNNING, time.time()))
+        self.db.commit()
+
+    def finish(self, alignment, status, stamp=None, inputHash=None, wallTime=None, peakRss=None, error=None):
+        # Records the outcome of the last attempt
+        # peakRss is how far the attempt raised the peak RSS of its worker above what the worker started with, in MB,
+        # None where it can't be measured. It is stored in the peak_rss_mb column
+        self.db.execute('''UPDATE alignments SET status = ?, input_stamp = ?, input_hash = ?, wall_time = ?,
+                           peak_rss_mb = ?, error = ?, updated = ? WHERE alignment = ?''',
+                        (status, stamp, inputHash, wallTime, peakRss, error, time.time(), str(alignment)))
+        self.db.commit()
+
+    def restamp(self, alignment, stamp):
+        # Updates the stamp of a done alignment whose files were touched but still hash the same
+        self.db.execute('UPDATE alignments SET input_stamp = ? WHERE alignment = ?', (stamp, str(alignment)))
+        self.db.commit()
+
+    def summary(self):
+        # Number of alignments in each status
+        return dict(self.db.execute('SELECT status, COUNT(*) FROM alignments GROUP BY status').fetchall())
+
+    def close(self):
+        self.db.close()
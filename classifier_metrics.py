@@ -0,0 +1,144 @@
+# Optional instrumentation for event_classifier.classifier.
+# A Metrics object times the stages of one alignment (wall time, CPU time, how far the stage raised the peak RSS) and keeps
+# counters of the work done in them (Hamming comparisons, candidate pairs, intervals counted). record() turns it into
+# one JSON-serialisable dict per alignment and summarise() aggregates those records across a batch.
+# Memory is read with the Unix-only resource module, elsewhere the memory figures are None and the timings still work.
+
+import collections
+import contextlib
+import json
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Totals kept for every stage
+STAGE_FIELDS = ('calls', 'wall', 'cpu', 'peak_growth_mb')
+
+def peak_rss_mb():
+    # Peak resident set size of this process so far, ru_maxrss is in KB on Linux
+    # None where there is no resource module (Windows)
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def largest(a, b):
+    # The larger of two memory figures, skipping the ones that are None
+    return b if a is None else a if b is None else max(a, b)
+
+def format_mb(value):
+    return '-' if value is None else f'{value:.0f}'
+
+class Metrics:
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Times the block as stage name, repeated stages add up their times
+        # peak_growth_mb is how far the block raised the peak RSS of the process: a stage that needs more memory than
+        # every stage before it shows by how much, a stage that fits within the peak so far shows 0
+        # a nested stage counts towards its own entry and the enclosing one
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        peak = peak_rss_mb()
+        try:
+            yield self
+        finally:
+            entry = self.stages.setdefault(name, dict.fromkeys(STAGE_FIELDS, 0))
+            entry['calls'] += 1
+            entry['wall'] += time.perf_counter() - wall
+            entry['cpu'] += time.process_time() - cpu
+            if peak is None:
+                entry['peak_growth_mb'] = None
+            else:
+                entry['peak_growth_mb'] += peak_rss_mb() - peak
+
+    def count(self, name, n=1):
+        self.counters[name] += int(n)
+
+    def merge(self, counters):
+        # Adds counters collected elsewhere, e.g. by the event workers
+        self.counters.update(counters)
+
+    def drain(self):
+        # Returns the counters as a dict and resets them, used by event workers to send their counts back per task
+        counters = dict(self.counters)
+        self.counters.clear()
+        return counters
+
+    def record(self, **fields):
+        # One dict per alignment: the given fields, the stages and the counters
+        return {**fields, 'stages': self.stages, 'counters': dict(self.counters), 'peak_rss_mb': peak_rss_mb()}
+
+class NoMetrics:
+    # Stands in for Metrics when instrumentation is off, every call is a no-op
+
+    def stage(self, name):
+        return contextlib.nullcontext(self)
+
+    def count(self, name, n=1):
+        pass
+
+    def merge(self, counters):
+        pass
+
+    def drain(self):
+        return {}
+
+    def record(self, **fields):
+        return None
+
+def write_record(path, record):
+    # Appends one record to a JSON lines file
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def summarise(records):
+    # Aggregates per-alignment records into a batch summary
+    # stages: summed calls, wall and CPU time, the largest peak growth of any alignment and each stage's share of the total wall time
+    # counters: summed over the batch
+    stages = {}
+    counters = collections.Counter()
+    for record in records:
+        for name, entry in record['stages'].items():
+            total = stages.setdefault(name, {**dict.fromkeys(STAGE_FIELDS, 0), 'peak_growth_mb': None})
+            total['calls'] += entry['calls']
+            total['wall'] += entry['wall']
+            total['cpu'] += entry['cpu']
+            total['peak_growth_mb'] = largest(total['peak_growth_mb'], entry['peak_growth_mb'])
+        counters.update(record['counters'])
+
+    peak = None
+    for record in records:
+        peak = largest(peak, record['peak_rss_mb'])
+
+    wall = sum(entry['wall'] for entry in stages.values()) or 1
+    for entry in stages.values():
+        entry['share'] = entry['wall'] / wall
+
+    return {
+        'alignments': len(records),
+        'stages': dict(sorted(stages.items(), key=lambda item: item[1]['wall'], reverse=True)),
+        'counters': dict(counters),
+        'peak_rss_mb': peak,
+    }
+
+def format_summary(summary):
+    # The summary as a text table, stages ordered by wall time
+    lines = [f"{summary['alignments']} alignments, peak RSS {format_mb(summary['peak_rss_mb'])} MB",
+             f"{'stage':<30}{'calls':>8}{'wall s':>12}{'cpu s':>12}{'share':>8}{'+peak MB':>10}"]
+    for name, entry in summary['stages'].items():
+        lines.append(f"{name:<30}{entry['calls']:>8}{entry['wall']:>12.2f}{entry['cpu']:>12.2f}"
+                     f"{entry['share']:>8.0%}{format_mb(entry['peak_growth_mb']):>10}")
+    for name, value in summary['counters'].items():
+        lines.append(f'{name}: {value:,}')
+    return '\n'.join(lines)
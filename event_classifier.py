@@ -7,39 +7,232 @@ import os
 from pathlib import Path
 import pandas as pd
 import numpy as np
-from collections import defaultdict
-import ast
-from Bio import SeqIO, AlignIO
-import distance
-from intervaltree import Interval, IntervalTree
+from Bio import AlignIO
 import re
-import itertools
-from math import ceil, floor, sqrt
-import sys
+from math import ceil, floor
+from multiprocessing import Pool, shared_memory
+import santa_io
+import classifier_cache
+import classifier_metrics
+import classifier_kernels
+
+# Alignments are held as raw byte codes, so the gap character is compared as its byte value.
+GAP = ord('-')
+
+# Columns of the parent table, in the order they are written to the .rdp5ML file
+OUTPUT_COLUMNS = ['SantaEventNumber', 'StartBP', 'EndBP', 'Recombinant', 'MinorParent', 'MajorParent', 'Score']
+
+def hamming_prefix_sums(recombinant, recombinant_gaps, parents, parent_gaps, positions):
+    # Cumulative gap-aware hamming distance between one recombinant and a block of candidate parents
+    # recombinant, recombinant_gaps: [genome length] alignment row of the recombinant and its gap mask
+    # parents, parent_gaps: [parents x genome length] alignment rows of the candidates and their gap masks
+    # positions: sorted, unique alignment positions starting at 0, every interval that will be counted must start and end on one of them
+    # (or at the genome length)
+    # returns (mismatches, sites), both [parents x len(positions) + 1] int32 prefix sums: column j counts positions [0, positions[j])
+    # and the last column the whole genome, so the count over an interval between two of those columns is cum[:, end] - cum[:, start]
+
+    # 'A-TT-G-' (Gaps at 1, 4 and 5)
+    # 'GG-TAA-' (Gap at 3 and 5)
+    # Union is {1,3,4,5}
+    # Compared sites will be 'ATG' and 'GTA'. Hamming distance will be 2 over 3 sites.
+    compared = ~(parent_gaps | recombinant_gaps)
+    differs = compared & (parents != recombinant)
+
+    # prefix sums are only needed at the given positions, so the segments between them are summed in one reduceat pass
+    # and only those segment sums are accumulated
+    mismatches = np.zeros((compared.shape[0], len(positions) + 1), dtype=np.int32)
+    sites = np.zeros((compared.shape[0], len(positions) + 1), dtype=np.int32)
+    np.cumsum(np.add.reduceat(differs.view(np.uint8), positions, axis=1, dtype=np.int32), axis=1, out=mismatches[:, 1:])
+    np.cumsum(np.add.reduceat(compared.view(np.uint8), positions, axis=1, dtype=np.int32), axis=1, out=sites[:, 1:])
+
+    return mismatches, sites
+
+def hamming_counts(recombinant, recombinant_gaps, parents, parent_gaps, regions, chunk=256):
+    # Gap-aware hamming distance between one recombinant and a whole set of candidate parents
+    # parents, parent_gaps: [parents x genome length], the rows to compare against and the positions to skip in each of them
+    # regions: list of (starts, ends) interval arrays, one per region that needs scoring
+    # returns (mismatches, sites), both [regions x parents]: the hamming distance and the number of compared
+    # nucleotides in each region once positions that are a gap in either sequence are discarded
+    parents = np.atleast_2d(parents)
+    parent_gaps = np.atleast_2d(parent_gaps)
+    genome_length = parents.shape[1]
+
+    # the prefix sum columns: every interval edge, and 0 so the first column counts nothing
+    positions = np.unique(np.concatenate([[0]] + [edges for region in regions for edges in region]))
+    positions = positions[positions < genome_length]
+    columns = np.append(positions, genome_length)
+    region_columns = [(np.searchsorted(columns, starts), np.searchsorted(columns, ends)) for starts, ends in regions]
+
+    mismatches = np.empty((len(regions), len(parents)), dtype=np.int64)
+    sites = np.empty((len(regions), len(parents)), dtype=np.int64)
+
+    # prefix sums are built for a block of parents at a time, after that every interval costs O(1) per parent
+    for lo in range(0, len(parents), chunk):
+        hi = lo + chunk
+        cum_mismatches, cum_sites = hamming_prefix_sums(recombinant, recombinant_gaps, parents[lo:hi], parent_gaps[lo:hi], positions)
+        for r, (starts, ends) in enumerate(region_columns):
+            mismatches[r, lo:hi] = (cum_mismatches[:, ends] - cum_mismatches[:, starts]).sum(axis=1)
+            sites[r, lo:hi] = (cum_sites[:, ends] - cum_sites[:, starts]).sum(axis=1)
+
+    return mismatches, sites
+
+def run_length_blocks(matrix):
+    # Run-length encodes every row of an integer matrix such as the generation matrix
+    # returns (rows, starts, ends, values) for every run of equal, non-zero entries, runs are [start, end)
+    # runs are ordered by row and then by position, the same order a row-major scan of the matrix meets them
+    n_cols = matrix.shape[1]
+
+    # a run starts at the first column and wherever an entry differs from its left neighbour
+    boundary = np.ones(matrix.shape, dtype=bool)
+    np.not_equal(matrix[:, 1:], matrix[:, :-1], out=boundary[:, 1:])
+    rows, starts = np.nonzero(boundary)
+
+    # a run ends where the next one starts, or at the end of its row
+    ends = np.full_like(starts, n_cols)
+    same_row = rows[1:] == rows[:-1]
+    ends[:-1][same_row] = starts[1:][same_row]
+
+    values = matrix[rows, starts]
+    keep = values != 0
+
+    return rows[keep], starts[keep], ends[keep], values[keep]
+
+def mask_intervals(mask):
+    # [start, end) intervals covering the runs of True in a boolean vector, as (starts, ends) arrays
+    edges = np.diff(mask.astype(np.int8), prepend=0, append=0)
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+def region_intervals(ranges, breakpoints, genome_length, window=200):
+    # Intervals of the four regions a recombinant is scored over, as a list of (starts, ends) arrays
+    # in order: minor close, minor far, major close, major far
+    # the minor region is the recombinant's ranges for the event, the major region everything outside the event breakpoints,
+    # "close" is within window nucleotides of either breakpoint, "far" is the rest
+    minor = np.zeros(genome_length, dtype=bool)
+    for start, end in ranges:
+        minor[start:end] = True
+
+    major = np.ones(genome_length, dtype=bool)
+    major[breakpoints[0]:breakpoints[1]] = False
+
+    close = np.zeros(genome_length, dtype=bool)
+    for bp in breakpoints[:2]:
+        close[max(0, bp-window):min(genome_length, bp+window+1)] = True
+
+    return [mask_intervals(region) for region in (minor & close, minor & ~close, major & close, major & ~close)]
+
+def pair_sums(minor_scores, major_scores):
+    #the two halves of a pair score for every potential parent, see findBestParentPair
+    #sum1 scores it as the minor parent (rows of the pair matrix), sum2 as the major parent (columns)
+
+    #condition 1, for every potential minor parent
+    distance_X_minor = np.where(np.isnan(minor_scores), 1, minor_scores)
+    distance_Y_minor = np.where(np.isnan(major_scores), 0, major_scores)
+    sum1 = distance_X_minor + (1-distance_Y_minor)
+
+    #condition 2, for every potential major parent
+    distance_Y_major = np.where(np.isnan(major_scores), 1, major_scores)
+    distance_X_major = np.where(np.isnan(minor_scores), 0, minor_scores)
+    sum2 = distance_Y_major + (1-distance_X_major)
+
+    return sum1, sum2
+
+def best_pair(sum1, sum2, chunk=1024):
+    # The lowest scoring accepted pair of a potential minor parent (sum1) and major parent (sum2), see findBestParentPair
+    # returns (minor index, major index, score), or None when no pair is accepted
+    best = None
+
+    #all possible pairs are scored as one broadcast [minor x major] matrix, built a block of rows at a time to bound memory
+    #argmin returns the first minimum in row-major order, which is the first pair the old itertools.product loop accepted
+    for lo in range(0, len(sum1), chunk):
+        pair_sum1 = sum1[lo:lo+chunk, None]
+        pair_score = pair_sum1 + sum2[None, :]
+        #pair score < 2 means at least < 2 pieces of sum arent None, sum1 or sum2 < 0.75 means evidence for at least one parent, even if not both         
+        accepted = (pair_score < 1.99) | (pair_sum1 < 0.75) | (sum2[None, :] < 0.75)
+        pair_score = np.where(accepted, pair_score, np.inf)
+
+        minor, major = np.unravel_index(np.argmin(pair_score), pair_score.shape)
+        if pair_score[minor, major] < (best[2] if best else float('inf')):
+            best = (lo + int(minor), int(major), float(pair_score[minor, major]))
+
+    return best
+
+def kernels(backend='numpy'):
+    # (hamming_counts, best_pair) of a resolved backend, the compiled ones from classifier_kernels or the NumPy ones above
+    if backend == 'numba':
+        return classifier_kernels.hamming_counts, classifier_kernels.best_pair
+    return hamming_counts, best_pair
+
+def output_path(alignment_path, outputDir='output'):
+    # The .rdp5ML file written for an alignment, named with the unique key of alignment_<key>.fa
+    key = re.search(r'(?<=alignment_).*', Path(alignment_path).name).group()[:-3]
+    return Path(outputDir) / ("RPD_Output_" + key + '.rdp5ML')
+
+def share_array(array):
+    # Copies an array into a new shared memory block so pool workers can read it without pickling
+    # returns (shared memory block, array view on the block), the caller closes and unlinks the block
+    memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+    shared[...] = array
+    return memory, shared
+
+# Set in each event worker by init_event_worker: the classifier used for scoring and the shared memory it reads from
+event_worker = None
+event_worker_memory = {}
+
+def init_event_worker(state, shared):
+    # Pool initializer for event-level parallelism
+    # state holds the small classifier attributes needed for scoring, shared maps attribute names to (block name, shape, dtype)
+    global event_worker
+    event_worker = classifier.__new__(classifier)
+    event_worker.__dict__.update(state)
+    for attr, (name, shape, dtype) in shared.items():
+        event_worker_memory[attr] = shared_memory.SharedMemory(name=name)
+        setattr(event_worker, attr, np.ndarray(shape, dtype=dtype, buffer=event_worker_memory[attr].buf))
+
+def score_event(task):
+    # Scores one event inside an event worker, task is (event_number, sequence_ranges_dict, pending)
+    # returns (best parents, the metrics counters of this event)
+    event_number, sequence_ranges_dict, pending = task
+    best_parents = event_worker.scoreEvent(event_number, sequence_ranges_dict, event_worker.deletedNucleotides, pending)
+    return (best_parents, event_worker.metrics.drain())
 
 class classifier:
-
-    def __init__(self, alig, rec, seq):      
-        # Recombination events and sequence events files
-        self.alignment = dict
+    # Construction only records the paths and settings, the work runs in stages when first needed and is kept:
+    # prepare() reads the inputs and builds the generation matrix, parents() calls the parents,
+    # results() returns them as a DataFrame and output() writes the .rdp5ML file.
+    # e.g. classifier(alig, rec, seq).output() or table = classifier(alig, rec, seq).results()
+
+    def __init__(self, alig, rec, seq, memmapDir=None, eventWorkers=1, layerSize=None, outputDir='output', breakpointWindow=200,
+                 cache=False, cacheDir=None, metrics=False, backend='auto'):      
+        # Alignment matrix is a uint8 numpy array of byte codes that is [number of alignments x max genome length]
+        # Sequence n lives in row n-1, the same row it has in the generation matrix.
+        self.alignment = np.array
+        self.seqIndex = {}
+
+        # Recombination events (EventNum, Start, End, Generation as int64 columns)
+        # and the sequence events map as a CSR of sequence -> events
         self.rec_events = pd.DataFrame
-        self.seq_events = pd.DataFrame
+        self.seq_events = santa_io.CSR
         
         # The longest genome in the alignment files.
         self.maxGenomeLength = 0
         self.numberOfSeqs = 0
 
         # Generation matrix is a numpy array that is [number of alignments x max genome length] ([row x columns])
+        # If memmapDir is given the matrix is written there as a memory-mapped .npy instead of being held in RAM
         self.generationMatrix = np.array
+        self.memmapDir = Path(memmapDir) if memmapDir is not None else None
+
+        # Run-length block map of the generation matrix as (rows, starts, ends, events), see run_length_blocks
+        self.blockRuns = None
 
-        # Dictionaries
-        self.seqmap_dict = dict
+        # Dictionary of event: (start, end) in the order of the recombination events file
+        # and the inverted sequence events map as a CSR of event -> sequences
         self.events_dict = dict
-        self.events_map = dict
-        self.inv_seqmap_dict = defaultdict(set)
+        self.event_seqs = santa_io.CSR
 
-        # Gap dict
-        self.gaps = defaultdict(set)
+        # Gap mask, [number of alignments x max genome length], True where the alignment holds a gap character
+        self.gaps = np.array
 
         # Get relavent files that will be used in the parsing
         self.alignment_path = Path(alig)
@@ -48,191 +241,272 @@ class classifier:
         self.major_parents = {}
         self.minor_parents = {}
 
-        # Read in files function
-        self.readFiles()
-        # Create dictionaries used in generation matrix
-        self.create_dictionaries()
-        # Find posistion of Gap characters in the sequences
-        self.getGaps()
-        # Create generation count matrix
-        self.createGenerationMatrix()
-        # Calc Parents
-        self.calcParents()
-        # Output to csv.
-        self.output()       
+        # Nucleotides within breakpointWindow of a breakpoint count twice in the distance scores
+        self.breakpointWindow = breakpointWindow
+
+        # Folder the .rdp5ML output is written to, relative to the working directory unless absolute
+        self.outputDir = Path(outputDir)
+
+        # Event level parallelism, eventWorkers > 1 scores the events of one layer concurrently.
+        # A layer is layerSize consecutive events of the reverse traversal, 4 per worker by default.
+        # Pool workers are daemonic, so this is for a classifier run from the main process.
+        self.eventWorkers = eventWorkers
+        self.layerSize = layerSize
+
+        # With cache=True the preprocessed inputs are stored in cacheDir (classifier_cache/ next to the alignment by default)
+        # and reused by later runs on the same, unchanged files, which then go straight to parent calling
+        self.cache = cache
+        self.cacheDir = Path(cacheDir) if cacheDir is not None else self.alignment_path.parent / classifier_cache.CACHE_FOLDER
+
+        # Kernels for the Hamming counts and the pair search: numba compiles them when installed (auto), numpy is the reference,
+        # both give the same parents. See classifier_kernels.
+        self.backend = classifier_kernels.resolve(backend)
+
+        # With metrics=True every stage is timed and the scoring work counted, see classifier_metrics and metricsRecord
+        self.metrics = classifier_metrics.Metrics() if metrics else classifier_metrics.NoMetrics()
+
+        # Results of the stages, set the first time each one runs
+        self.prepared = False
+        self.parentRows = None
+        self.resultTable = None
+
+    def prepare(self):
+        # Stage 1: everything parent calling needs, from the cache when there is an entry for the inputs
+        if self.prepared:
+            return self
+
+        cached = False
+        if self.cache:
+            with self.metrics.stage('loadCache'):
+                cached = self.loadCache()
+
+        if not cached:
+            # Read in files function
+            with self.metrics.stage('readFiles'):
+                self.readFiles()
+            # Create dictionaries used in generation matrix
+            with self.metrics.stage('create_dictionaries'):
+                self.create_dictionaries()
+            # Find posistion of Gap characters in the sequences
+            with self.metrics.stage('getGaps'):
+                self.getGaps()
+            # Create generation count matrix
+            with self.metrics.stage('createGenerationMatrix'):
+                self.createGenerationMatrix()
+            if self.cache:
+                with self.metrics.stage('saveCache'):
+                    self.saveCache()
+
+        self.prepared = True
+        return self
+
+    def parents(self):
+        # Stage 2: the best parents of every recombinant, as a list of rows in OUTPUT_COLUMNS order
+        # rows are grouped by event from the highest event number down, the order calcParents traverses them
+        if self.parentRows is None:
+            self.prepare()
+            self.calcParents()
+
+            rows = []
+            for events in self.minor_parents.keys():
+                startBP, EndBP = self.events_dict[events]
+                for minorTup, MajorTup in zip(self.minor_parents[events], self.major_parents[events]):
+                    rows.append((events, startBP, EndBP, minorTup[0], minorTup[1], MajorTup[1], minorTup[2]))
+            self.parentRows = rows
+
+        return self.parentRows
+
+    def results(self):
+        # The parents as an in-memory table with the OUTPUT_COLUMNS, nothing is written to disk
+        if self.resultTable is None:
+            self.resultTable = pd.DataFrame(self.parents(), columns=OUTPUT_COLUMNS)
+        return self.resultTable
+
+    def metricsRecord(self):
+        # The stage timings and counters of this alignment as one JSON-serialisable dict, None without metrics=True
+        return self.metrics.record(alignment=self.alignment_path.name, sequences=self.numberOfSeqs,
+                                   genome_length=self.maxGenomeLength, events=len(self.rec_events) if self.prepared else 0)
 
 
     def readFiles(self):
         # JOSH: Trying the AlignIO feature from BioPython as they have get max length and number of Seq Fnc.
         # Useful if faster than my function for this.
-        self.alignment = AlignIO.read(self.alignment_path, 'fasta')
-        self.maxGenomeLength = self.alignment.get_alignment_length()
-        self.numberOfSeqs = self.alignment.__len__()
-        self.alignment = SeqIO.to_dict(self.alignment)
-        #self.alignment = SeqIO.to_dict(SeqIO.parse(self.alignment_path, 'fasta'))
-
-        #changing to just store sequence, dont need other entries that biopython stores in dictionary        
-        for k, v in self.alignment.items():
-            self.alignment[k] = v.seq
-
-        # Read in Recombination events file
-        self.rec_events = pd.read_csv(
-            self.rec_events_path,
-            sep=r"*",
-            usecols=["EventNum", "Breakpoints", "Generation"],
-        )
-
-        # Remove the brackets surrounding breakpoints
-        self.rec_events.Breakpoints = self.rec_events.Breakpoints.str.strip("[]") 
+        alignment = AlignIO.read(self.alignment_path, 'fasta')
+        self.maxGenomeLength = alignment.get_alignment_length()
+        self.numberOfSeqs = alignment.__len__()
+
+        # Encode the alignment once into a compact uint8 matrix, the records are dropped afterwards
+        # so every later stage works on array slices rather than Seq objects or strings.
+        self.alignment = np.empty((self.numberOfSeqs, self.maxGenomeLength), dtype=np.uint8)
+        for record in alignment:
+            row = int(record.id) - 1
+            self.seqIndex[record.id] = row
+            self.alignment[row] = np.frombuffer(bytes(record.seq), dtype=np.uint8)
+        del alignment
+
+        # Read in Recombination events file, breakpoints are split into integer Start and End columns
+        self.rec_events = santa_io.read_recombination_events(self.rec_events_path)
 
         #Fix for ending breakpoints that don't count gap characters        
-        ungapped_length = len(self.alignment['1'].ungap("-"))
+        ungapped_length = self.maxGenomeLength - int(np.count_nonzero(self.alignment[self.seqIndex['1']] == GAP))
         if ungapped_length != self.maxGenomeLength:
-            for i, bps in enumerate(self.rec_events["Breakpoints"]):
-                start_pos = (bps.split(",")[0])
-                end_pos = int(bps.split(",")[-1])                
-                if int(end_pos) == ungapped_length:
-                    self.rec_events["Breakpoints"].iat[i] = start_pos + ", " + str(self.maxGenomeLength)
-
-        # Split breakpoints into start and end, drop breakpoints
-        self.rec_events[["Start", "End"]] = self.rec_events.Breakpoints.str.split(",", expand=True,)      
+            self.rec_events.loc[self.rec_events.End == ungapped_length, "End"] = self.maxGenomeLength
 
         # Read in sequence events map
-        self.seq_events = pd.read_csv(self.seq_events_path, delimiter="*", index_col="Sequence")
+        self.seq_events = santa_io.read_sequence_events_map(self.seq_events_path)
 
     def create_dictionaries(self):
         # generating dictionaries from dataframes
-        self.seqmap_dict = {
-            i: ast.literal_eval(v)
-            for i, v in enumerate(self.seq_events["Events"].to_numpy(), 1)
-        }
-        self.events_dict = {
-            event: ast.literal_eval(bp)
-            for event, bp in zip(
-                self.rec_events["EventNum"], self.rec_events["Breakpoints"]
-            )
-        }
+        self.events_dict = dict(zip(
+            self.rec_events.EventNum.tolist(),
+            zip(self.rec_events.Start.tolist(), self.rec_events.End.tolist()),
+        ))
        
-        # Creating an inverted seqmap dictionary (event:sequences instead of sequence:events)
-        # with key,value pairs: event, [sequences containing event]
-        for key, value in self.seqmap_dict.items():
-            for eventnum in value:
-                self.inv_seqmap_dict[eventnum].add(key)
+        # Creating an inverted seqmap (event:sequences instead of sequence:events)
+        # row k holds the sequences containing event self.event_seqs.keys[k]
+        self.event_seqs = santa_io.invert_csr(self.seq_events)
 
     def getGaps(self):
-        for key, seq in self.alignment.items():
-            currentGaps = ([pos for pos, char in enumerate(str(seq)) if char == '-'])
-            self.gaps[int(key)] = currentGaps
+        # One vectorised pass over the alignment matrix, rows line up with self.alignment
+        self.gaps = self.alignment == GAP
 
     def createGenerationMatrix(self):
         # Generation matrix is a numpy array that is [number of alignments x max genome length] ([row x columns])
+        # Entries are event numbers (0 where no event touched the nucleotide), held as int32 unless the event numbers need int64
 
-        #self.generationMatrix = np.zeros(shape=(self.numberOfSeqs, self.maxGenomeLength))
-        self.generationMatrix = np.full(shape=(self.numberOfSeqs, self.maxGenomeLength), dtype='O', fill_value=0)
-        #for key, gaps in self.gaps.items():
-            #self.generationMatrix[key-1, [pos for pos in gaps]] = '-'
+        #The sorted event keys
+        eventList = self.event_seqs.keys
 
-        #Create a sorted list of the event keys
-        eventList = sorted([*self.inv_seqmap_dict.keys()])
+        dtype = np.int32
+        if eventList.size and eventList[-1] > np.iinfo(np.int32).max:
+            dtype = np.int64
 
-        for event in eventList:
-            seqs = self.inv_seqmap_dict[event]
-            
-            # Python is zero indexed.
-            start = int(self.rec_events.Start[self.rec_events.EventNum == int(event)])
-            end = int(self.rec_events.End[self.rec_events.EventNum == int(event)])
+        shape = (self.numberOfSeqs, self.maxGenomeLength)
+        if self.memmapDir is not None:
+            os.makedirs(self.memmapDir, exist_ok=True)
+            matrixPath = self.memmapDir / (self.alignment_path.stem + '.generation.npy')
+            # a freshly created .npy memmap is zero filled
+            self.generationMatrix = np.lib.format.open_memmap(matrixPath, mode='w+', dtype=dtype, shape=shape)
+        else:
+            self.generationMatrix = np.zeros(shape, dtype=dtype)
 
-            box = []
-            for x in iter(seqs):
-                box.append(x - 1)
+        # Pre-index the (start, end) of every event once, rather than filtering rec_events twice per event
+        bounds = self.rec_events.set_index("EventNum").loc[eventList, ["Start", "End"]].to_numpy()
 
-            self.generationMatrix[box, start : (end)] = np.full(
+        # Python is zero indexed. Later events overwrite earlier ones.
+        indptr = self.event_seqs.indptr
+        for k, (event, (start, end)) in enumerate(zip(eventList.tolist(), bounds.tolist())):
+            box = self.event_seqs.indices[indptr[k]:indptr[k+1]] - 1
+            self.generationMatrix[box, start:end] = event
 
-                (len(seqs), end - start), int(event), dtype=np.int32)
+        if isinstance(self.generationMatrix, np.memmap):
+            self.generationMatrix.flush()
 
         print(self.alignment_path.name)
 
+    def cacheKey(self):
+        # Content hash of the three input files, see classifier_cache.input_key
+        return classifier_cache.input_key(self.alignment_path, self.rec_events_path, self.seq_events_path)
+
+    def saveCache(self):
+        # Stores the alignment matrix, event arrays, generation matrix and block map for later runs on the same inputs
+        if self.blockRuns is None:
+            self.blockRuns = run_length_blocks(self.generationMatrix)
+        rows, starts, ends, events = self.blockRuns
+        ids = np.empty(self.numberOfSeqs, dtype=object)
+        for seq_id, row in self.seqIndex.items():
+            ids[row] = seq_id
+
+        classifier_cache.save(self.cacheDir, self.alignment_path.stem, self.cacheKey(), {
+            'alignment': self.alignment,
+            'generationMatrix': self.generationMatrix,
+            'seqIds': ids.astype(str),
+            'EventNum': self.rec_events.EventNum.to_numpy(),
+            'Start': self.rec_events.Start.to_numpy(),
+            'End': self.rec_events.End.to_numpy(),
+            'Generation': self.rec_events.Generation.to_numpy(),
+            'seqKeys': self.seq_events.keys,
+            'seqIndptr': self.seq_events.indptr,
+            'seqIndices': self.seq_events.indices,
+            'blockRows': rows,
+            'blockStarts': starts,
+            'blockEnds': ends,
+            'blockEvents': events,
+        })
+
+    def loadCache(self):
+        # Restores everything saveCache stores, returns False if there is no entry for the current inputs
+        # the alignment and generation matrices are memory-mapped read-only from the cache
+        stored = classifier_cache.load(self.cacheDir, self.alignment_path.stem, self.cacheKey())
+        if stored is None:
+            return False
+
+        self.alignment = stored['alignment']
+        self.numberOfSeqs, self.maxGenomeLength = self.alignment.shape
+        self.seqIndex = {seq_id: row for row, seq_id in enumerate(stored['seqIds'].tolist())}
+
+        # the End column already holds the fix for ending breakpoints
+        self.rec_events = pd.DataFrame({column: stored[column] for column in ('EventNum', 'Start', 'End', 'Generation')})
+        self.seq_events = santa_io.CSR(stored['seqKeys'], stored['seqIndptr'], stored['seqIndices'])
+
+        self.generationMatrix = stored['generationMatrix']
+        self.blockRuns = (stored['blockRows'], stored['blockStarts'], stored['blockEnds'], stored['blockEvents'])
+
+        # the dictionaries and the gap mask are cheap to rebuild from the arrays
+        self.create_dictionaries()
+        self.getGaps()
 
-    def calcHammingDistance(self, seq1, seq2):
-        #calculates hamming distance between seq1 and seq2
-        #returns a list: (hamming distance, nucleotide count of compared sequences once gap characters are discarded)     
-     
-        # Set for instances where seq1 and seq2 are 0 after dropping -        
-        maxGenLength = self.maxGenomeLength
-
-        #Length of Seqs
-        totalLen = len(seq1)
-
-        # Find the index of the gap characters in both sequences
-        seq1Gaps = ({pos for pos, char in enumerate(str(seq1)) if char == '-'})
-        seq2Gaps = ({pos for pos, char in enumerate(str(seq2)) if char == '-'})
-
-        # Find the union of these Gap characters
-        union = seq1Gaps | seq2Gaps
-        
-        # Remove the characters at the indexes of the union. 
-        # 'A-TT-G-' (Gaps at 1, 4 and 5)
-        # 'GG-TAA-' (Gap at 3 and 5)
-        # Union is {1,3,4,5}
-        # Output sequences will be 'ATG' and 'GTA'. Hamming distance will be 2. 
-        # Normalised over the total sites where neither sequence has a gap (3)
-        # 2/3 = 0.66
-
-        for count, indx in enumerate(sorted(union)):
-            seq1 = seq1[:indx-count] + seq1[indx+1-count:]
-            seq2 = seq2[:indx-count] + seq2[indx+1-count:]
-        
-        #returns the hamming distance between two sequences
-        d = distance.hamming(seq1, seq2)
-
-        #Length of seqs
-        remainingNucleotides = len(seq1)
-       
-        if remainingNucleotides > 0:   
-            return [d, remainingNucleotides]  
-        else:
-            return None
+        print(self.alignment_path.name + ' (cached)')
+        return True
 
     def hyper_ci_approximation(self, x, n, N):
-        #calculates a confidence interval using a normal approximation to the hypergeometric distribution
+        #calculates confidence intervals using a normal approximation to the hypergeometric distribution, for arrays of inputs
         #x = count in sample with measured property (nucleotides mismatches in this case)
         #n = sample size
         #N = population size        
-        t = N
+        #returns (lower bounds, upper bounds, invalid) where invalid marks inputs that don't meet x <= n <= N (bounds are NaN there)
+        x = np.asarray(x, dtype=np.int64)
+        n = np.asarray(n, dtype=np.int64)
+        t = np.asarray(N, dtype=np.int64)
 
         p = (x+1)/(n+2)
-        cor = (t-n)/(t-1)     
-        try:       
-            me = 2.575829*sqrt(cor*p*(1-p)/(n+4))
-        except:
-            print("Error, Need: x <= n <= N")
-            print(x)
-            print(n)
-            print(N)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cor = (t-n)/(t-1)     
+            variance = cor*p*(1-p)/(n+4)
+        invalid = ~(variance >= 0) | (t == 1)
+        me = 2.575829*np.sqrt(np.where(invalid, 0, variance))
        
         lcl = p - me
         ucl = p + me
 
-        LCL = max(0, round(t*lcl))
-        UCL = min(t, round(t*ucl))
+        #np.rint rounds halves to even, the same as round()
+        LCL = np.maximum(0, np.rint(t*lcl))
+        UCL = np.minimum(t, np.rint(t*ucl))
 
-        out = (LCL/N, UCL/N)
+        lower = LCL/t
+        upper = UCL/t
 
         #applying a heuristic correction, since normal approximation fails and underestimates UCL when x = 0 and sample size is low        
-        if x == 0 and n < 20:
-            out = (LCL/N, 1.5*UCL/N)
+        upper = np.where((x == 0) & (n < 20), 1.5*UCL/t, upper)
 
-        return out
+        lower[invalid] = np.nan
+        upper[invalid] = np.nan
+
+        return (lower, upper, invalid)
 
     def calcNormalisedDistanceScore(self, distance, length, fragment_length):            
+        #normalised distance scores for arrays of hamming distances, compared nucleotides and fragment lengths
+        #returns (scores, invalid), see hyper_ci_approximation for invalid
+        distance = np.asarray(distance, dtype=np.int64)
+        length = np.asarray(length, dtype=np.int64)
+        fragment_length = np.asarray(fragment_length, dtype=np.int64)
 
-        if (int(length) == int(fragment_length)):
-            normalisedDistanceScore = distance/length
-        else: 
-            CI = self.hyper_ci_approximation(int(distance), int(length), int(fragment_length)) 
-            normalisedDistanceScore = CI[1] 
+        _, upper, invalid = self.hyper_ci_approximation(distance, length, fragment_length)
+        whole_fragment = length == fragment_length
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normalisedDistanceScore = np.where(whole_fragment, distance/length, upper)
 
-        return normalisedDistanceScore
+        return (normalisedDistanceScore, invalid & ~whole_fragment)
 
     def findEventPositions(self):
         #we need to know where the "recombination event blocks" are, i.e. which sections of the alignment we need to compare sequences within to find parents
@@ -248,236 +522,160 @@ class classifier:
         #without having to search it for all entries of a given event number
         block_dict = {x:{} for x in self.events_dict.keys()}      
        
-        #extracting raw array
-        gen_matrix = self.generationMatrix   
-       
-        #iterate through generation matrix, where index = a tuple (sequence name, nucleotide position) 
-        for index, entry in np.ndenumerate(gen_matrix):
-            #entry of 0 means no recombination event touched this nucleotide, so we don't have to do anything            
-            if not (entry == 0):
-                seq = index[0]
-                nucleotide_pos = index[1]              
-                
-                if seq in block_dict[entry]:
-                    #if entry exists, change as appropiate
-                    min_max = block_dict[entry][seq]
-                    max_pos = min_max[-1][-1]                    
-
-                    if nucleotide_pos == max_pos:
-                        #continuous, uninterrupted block of same event, thus just add +1 to maximum range
-                        min_max[-1][-1] += 1
-                        block_dict[entry][seq] = min_max
-                    else:
-                        #discontinuity, so need to make a new range of nucleotides
-                        min_max.append([nucleotide_pos, nucleotide_pos+1])
-                        block_dict[entry][seq] = min_max
-                else:   
-                    #if dictionary entry doesnt exist yet, create a new one          
-                    block_dict[entry][seq] = [[nucleotide_pos, nucleotide_pos+1]]
+        #run-length encode the generation matrix instead of visiting every cell, entries of 0 (no recombination event) are dropped
+        #runs come out ordered by sequence and then nucleotide position, so the sequences of every event and their ranges
+        #are inserted in the same order as a cell by cell scan would
+        #a cached run reuses the stored encoding
+        if self.blockRuns is None:
+            self.blockRuns = run_length_blocks(self.generationMatrix)
+        rows, starts, ends, events = self.blockRuns
+        for seq, start, end, entry in zip(rows.tolist(), starts.tolist(), ends.tolist(), events.tolist()):
+            block_dict[entry].setdefault(seq, []).append([start, end])
 
         return block_dict
 
-    def findBestParentPair(self, minor_parent_dict, major_parent_dict):
-        #given two lists: one list of potential minor parents and one list of potential major parents, this function returns the best parent pair
+    def findBestParentPair(self, parents, minor_scores, major_scores):
+        #given the potential parents and their minor and major region distance scores, this function returns the best parent pair
+        #minor_scores and major_scores are arrays in the order of parents, NaN where no distance score could be calculated
         #the "best" pair meets the following two conditions, if X is the region inherited from minor parent and Y from the major parent
 
         #1) in X: distance between recombinant and minor parent is minimised while distance between recombinant and major parent is maximised
         #2) in Y: distance between recombinant and major parent is minimised while distance between recombinant and minor parent is maximised
 
-        #all possible pairs:
-        all_pairs = list(itertools.product(minor_parent_dict.items(), major_parent_dict.items()))
-        min_score = float('inf')
-        best_pair = ()
-        all_scores = []
-       
-        for pair in all_pairs:      
-            #condition 1
-            distance_X_minor = pair[0][1] if pair[0][1]!=None else 1
-            distance_X_major = minor_parent_dict[pair[1][0]] if minor_parent_dict[pair[1][0]]!=None else 0            
-            
-            #condition 2
-            distance_Y_major = pair[1][1] if pair[1][1]!=None else 1
-            distance_Y_minor = major_parent_dict[pair[0][0]] if major_parent_dict[pair[0][0]]!=None else 0
-
-            sum1 = distance_X_minor + (1-distance_Y_minor)
-            sum2 = distance_Y_major + (1-distance_X_major)
-
-            pair_score = sum1 + sum2  
-            #pair score < 2 means at least < 2 pieces of sum arent None, sum1 or sum2 < 0.75 means evidence for at least one parent, even if not both         
-            if pair_score < min_score and (pair_score < 1.99 or (sum1 < 0.75 or sum2 < 0.75)):
-                min_score = pair_score
-                best_pair = (pair[0][0], pair[1][0])  
-                all_scores.append(pair_score)      
-
-        return (best_pair, min_score)
-
-    def intersection_trees(self, a, b):
-        #returns intersection given two lists of ranges
-        #sort both:
-        a = list(sorted(a))
-        b = list(sorted(b))
-
-        ranges = []
-        i = j = 0
-        while i < len(a) and j < len(b):
-            a_left, a_right, t = (a)[i]
-            b_left, b_right, u = (b)[j]
-            a_right -= 1
-            b_right -= 1
-
-            if a_right < b_right:
-                i += 1
-            else:
-                j += 1
-
-            if a_right >= b_left and b_right >= a_left:
-                end_pts = sorted([a_left, a_right, b_left, b_right])
-                middle = [end_pts[1], end_pts[2]]
-                ranges.append(middle)
+        #condition 1 for every potential minor parent (rows of the pair matrix), condition 2 for every potential major parent (columns)
+        sum1, sum2 = pair_sums(minor_scores, major_scores)
+
+        #the first accepted pair with the lowest score, see best_pair
+        best = kernels(self.backend)[1](sum1, sum2)
+        if best is None:
+            return ((), float('inf'))
+        minor, major, min_score = best
+        return ((int(parents[minor]), int(parents[major])), min_score)
+
+    def weightedDistanceScore(self, close_distance, far_distance, block_length):
+        #combines the close and far part of one region into its normalised distance score, for every potential parent at once
+        #close_distance and far_distance are (hamming distances, compared nucleotides) arrays, a part with 0 compared nucleotides
+        #is missing (every site was a gap or deleted)
+        #returns (scores, invalid), scores are NaN where neither part could be compared
+        close_mismatches, close_sites = close_distance
+        far_mismatches, far_sites = far_distance
+        has_close = close_sites > 0
+        has_far = far_sites > 0
 
-        ri = 0
-        while ri < len(ranges)-1:
-            if ranges[ri][1] == ranges[ri+1][0]:
-                ranges[ri:ri+2] = [[ranges[ri][0], ranges[ri+1][1]]]
-
-            ri += 1
+        #nucleotides close to breakpoints are weighted twice as much
+        block_length = block_length + close_sites
 
-        try:
-            #since interval trees exclude upper ranges, need to add 1
-            ranges = [(x, y+1) for x,y in ranges]
-            #forming output
-            out = IntervalTree.from_tuples(ranges)
-            out.merge_overlaps()
-        except:
-            print("!!!!!!")
-            print("Invalid ranges")
-            print(a)
-            print(b)
-            print(ranges)
-            sys.exit()
-
-        return out
-
-    def findDistanceScores(self, parent, ranges, deleted_nucleotides, parent_seq, recombinant_seq, event_number):
-        #finds normalised distance scores, for both minor and major parent regions, between recombinant and potential parent
-        #also weights nucleotides within 200 nucleotides of breakpoints 2x more               
+        #now we just add the hamming distances and nucleotide counts for close and far together
+        #we will use this total for the statistic to calc the final normalised distance score
+        total_mismatches = 2*close_mismatches + far_mismatches
+        total_sites = 2*close_sites + far_sites
+
+        #if the totals exist, go ahead and calc the final score
+        scores, invalid = self.calcNormalisedDistanceScore(total_mismatches, total_sites, block_length)
+        has_totals = has_close | has_far
+        scores[~has_totals] = np.nan
+
+        return (scores, invalid & has_totals)
+
+    def findDistanceScores(self, recombinant, ranges, parent_alignment, parent_excluded, event_number):
+        #finds normalised distance scores, for both minor and major parent regions, between a recombinant and every potential parent
+        #also weights nucleotides within self.breakpointWindow nucleotides of breakpoints 2x more
+        #parent_alignment is [parents x genome length], the alignment rows of the potential parents
+        #parent_excluded is [parents x genome length], True where a parent has a gap or a nucleotide deleted by a later event
+        #returns two arrays (minor scores, major scores) in the order of parents
         event_breakpoints = self.events_dict[event_number]
-       
-        #if we do minor parents, take recombinant region and then remove intervals that have been deleted        
-        ranges_tree_minor = IntervalTree.from_tuples(ranges)        
-        if parent in deleted_nucleotides.keys():                                                         
-            for j in deleted_nucleotides[parent]:
-                ranges_tree_minor.chop(j.begin, j.end)  
-
-        #for major parents, its the same except we take the complement of the recombinant region (all regions not in the recombinant region) 
-        recombinant_region = (event_breakpoints[0], event_breakpoints[1])
-        recombinant_region = IntervalTree.from_tuples([recombinant_region])       
-        ranges_tree_major = IntervalTree.from_tuples([[0, self.maxGenomeLength]])
-        for r in recombinant_region:
-            ranges_tree_major.chop(r.begin, r.end)
-        if parent in deleted_nucleotides.keys():                                               
-            for j in deleted_nucleotides[parent]:
-                ranges_tree_major.chop(j.begin, j.end)     
-
-
-        #now we split both minor and major ranges into two parts: 1. nucleotides close to breakpoints, 2. nucleotides not close to breakpoints
-        #"close" here is within 200 nucleotides of a breakpoint position
-        minor_tree_ranges_far, minor_tree_ranges_close = IntervalTree(), IntervalTree()
-        major_tree_ranges_far, major_tree_ranges_close = IntervalTree(), IntervalTree() 
-              
-        tup1 = (max(0, event_breakpoints[0]-200), min(self.maxGenomeLength, event_breakpoints[0]+200+1))
-        tup2 = (max(0, event_breakpoints[1]-200), min(self.maxGenomeLength, event_breakpoints[1]+200+1))
-        ranges_close_to_bps = IntervalTree.from_tuples([tup1, tup2])  
-
-        #find intersection with minor, major trees to find ranges close to breakpoints:
-        minor_tree_ranges_close = self.intersection_trees(ranges_tree_minor, ranges_close_to_bps)  
-        major_tree_ranges_close = self.intersection_trees(ranges_tree_major, ranges_close_to_bps)
-
-        #now if we remove the ranges that intersect, we are left with the nucleotides that arent close
-        for j in minor_tree_ranges_close:
-            ranges_tree_minor.chop(j.begin, j.end)
-        minor_tree_ranges_far = ranges_tree_minor   
-        
-        for h in major_tree_ranges_close:
-            ranges_tree_major.chop(h.begin, h.end)
-        major_tree_ranges_far = ranges_tree_major  
-
-
-        def return_distances(x, y, ranges):
-            #returns hamming distance and score given two sequences and intervals of nucleotides            
-            seq1 = '' 
-            seq2 = ''
-            for k in ranges:  
-                seq1 = seq1 + x[k.begin:k.end]
-                seq2 = seq2 + y[k.begin:k.end]
-
-            #calculating hamming distance      
-            hamming_distance = self.calcHammingDistance(seq1, seq2)              
 
-            return hamming_distance
+        #the minor region is the recombinant region, the major region is its complement (all regions not in the recombinant region)
+        #both are split into nucleotides close to the breakpoints and the rest. These intervals are the same for every parent,
+        #each parent's deleted nucleotides are dropped through parent_excluded in the same pass as the gaps
+        regions = region_intervals(ranges, event_breakpoints, self.maxGenomeLength, self.breakpointWindow)
+        self.metrics.count('interval_operations', sum(len(starts) for starts, _ in regions) * len(parent_alignment))
 
-        #now calculate the distance scores for close and far nucleotide ranges, and use a weighted average for the final score
-        #close nucleotides are weighted more heavily
+        #returns [regions x parents] hamming distances and nucleotide pair counts used for distance comparison (sample size for stat calc)
+        mismatches, sites = kernels(self.backend)[0](self.alignment[recombinant], self.gaps[recombinant],
+                                                     parent_alignment, parent_excluded, regions)
 
         #we need block length to calculate geometric statistic (to normalise for length)
         recombinant_block_length = event_breakpoints[1] - event_breakpoints[0]
         major_block_length = self.maxGenomeLength - recombinant_block_length 
 
-        #calculating hamming distances, where close nucleotides are double weighted
-        #returns a list [distance, length] where length is nucleotide pair count used for distance comparison (sample size for stat calc)
-        minor_close_distance = return_distances(recombinant_seq, parent_seq, minor_tree_ranges_close)
-        minor_far_distance = return_distances(recombinant_seq, parent_seq, minor_tree_ranges_far)
-        major_close_distance = return_distances(recombinant_seq, parent_seq, major_tree_ranges_close)
-        major_far_distance = return_distances(recombinant_seq, parent_seq, major_tree_ranges_far)  
-
-        #nucleotides close to breakpoints are weighted twice as much
-        if minor_close_distance:            
-            recombinant_block_length = recombinant_block_length + minor_close_distance[1]           
-            minor_close_distance = [2*x for x in minor_close_distance]            
-        if major_close_distance:            
-            major_block_length = major_block_length + major_close_distance[1]           
-            major_close_distance = [2*y for y in major_close_distance] 
+        distance_scores_minor, invalid_minor = self.weightedDistanceScore((mismatches[0], sites[0]), (mismatches[1], sites[1]), recombinant_block_length)
+        distance_scores_major, invalid_major = self.weightedDistanceScore((mismatches[2], sites[2]), (mismatches[3], sites[3]), major_block_length)
+
+        if invalid_minor.any() or invalid_major.any():
+            raise ValueError(f"Error, Need: x <= n <= N for the distance scores of sequence {recombinant+1} in event {event_number}")
+
+        #NaN where nothing could be compared
+        return (distance_scores_minor, distance_scores_major)
+
+    def scoreEvent(self, event_number, sequence_ranges_dict, deleted_nucleotides, pending=()):
+        #calculates "best" minor and major parents for every recombinant sequence of one event
+        #deleted_nucleotides is the deleted nucleotide matrix from the events already traversed
+        #pending is a list of sequence_ranges_dict for events traversed before this one whose ranges aren't in deleted_nucleotides yet,
+        #only used when the events of a layer are scored in parallel
+        #returns (best_parents_minor, best_parents_major)
+
+        #divide sequences into recombinant and potential parents
+        #the candidates keep the iteration order of the set difference, so tied pairs resolve to the same parents as before
+        sequences_in_block = set(sequence_ranges_dict.keys())
+        sequences_not_in_block = np.fromiter(set(range(self.numberOfSeqs)) - sequences_in_block, dtype=np.intp)
+        best_parents_minor = []
+        best_parents_major = []
+
+        #the rows of the potential parents and the positions that can't be compared for each: its gaps and its deleted nucleotides
+        #recombinants are never potential parents of their own event, so both hold for the whole event
+        parent_alignment = self.alignment[sequences_not_in_block]
+        parent_excluded = self.gaps[sequences_not_in_block] | deleted_nucleotides[sequences_not_in_block]
+        if pending:
+            parent_rows = {parent: i for i, parent in enumerate(sequences_not_in_block.tolist())}
+            for pending_ranges_dict in pending:
+                for sequence, ranges in pending_ranges_dict.items():
+                    if sequence in parent_rows:
+                        for start, end in ranges:
+                            parent_excluded[parent_rows[sequence], start:end] = True
+
+        #calculate best parents for all sequences of the current recombination event
+        for sequence, ranges in sequence_ranges_dict.items():  
+
+            self.metrics.count('hamming_calls')
+            self.metrics.count('hamming_comparisons', len(sequences_not_in_block))
+            self.metrics.count('candidate_pairs', len(sequences_not_in_block)**2)
+
+            #calculate scores for all potential parents at once
+            hamming_distances_minor, hamming_distances_major = self.findDistanceScores(sequence, ranges, parent_alignment, parent_excluded, event_number)
+
+            #find best parents:
+            best_parents_score = self.findBestParentPair(sequences_not_in_block, hamming_distances_minor, hamming_distances_major) 
+            best_parents = best_parents_score[0]
+            best_score = best_parents_score[1]           
+
+            #if a viable best parent pair could be found, add to list
+            if best_parents:   
+                best_minor_parent = ''
+                best_major_parent = ''
+
+                if isinstance(best_parents[0], int):
+                    best_minor_parent = str(best_parents[0]+1)
+                else:
+                    best_minor_parent = best_parents[0]
+                if isinstance(best_parents[1], int):
+                    best_major_parent = str(best_parents[1]+1)
+                else:
+                    best_major_parent = best_parents[1]
 
-        #now we just add the hamming distances and nucleotide counts for close and far together
-        #we will use this total for the statistic to calc the final normalised distance score
-        if minor_close_distance and minor_far_distance:
-            minor_totals = [x+y for x,y in zip(minor_close_distance, minor_far_distance)]
-        elif minor_close_distance:
-            minor_totals = minor_close_distance
-        elif minor_far_distance:
-            minor_totals = minor_far_distance
-        else:
-            minor_totals = None
-
-        if major_close_distance and major_far_distance:
-            major_totals = [x+y for x,y in zip(major_close_distance, major_far_distance)]
-        elif major_close_distance:
-            major_totals = major_close_distance
-        elif major_far_distance:
-            major_totals = major_far_distance
-        else:
-            major_totals = None
-    
-        #if the totals exist (not none), go ahead and calc the final scores
-        if minor_totals:  
-            distance_score_minor = self.calcNormalisedDistanceScore(minor_totals[0], minor_totals[1], recombinant_block_length)           
-        else:
-            distance_score_minor = None
-        if major_totals:
-            distance_score_major = self.calcNormalisedDistanceScore(major_totals[0], major_totals[1], major_block_length)
-        else:
-            distance_score_major = None    
+                best_parents_minor.append((sequence+1, best_minor_parent, best_score))
+                best_parents_major.append((sequence+1, best_major_parent, best_score))                 
 
-        return (distance_score_minor, distance_score_major)
+        return (best_parents_minor, best_parents_major)
 
     def calculateParents(self, block_dict):                  
         #calculates "best" minor and major parents
     
         #this variable (deleted_nucleotides) will keep track of nucleotides with higher event numbers than all current events under consideration,
         #thus if a nucleotide falls into this range, it shouldnt be considered for parent calculations
-        #Format is {sequence_name: interval_tree}
-        #interval tree holds all intervals of deleted nucleotides
-        deleted_nucleotides = {}
+        #Format is a boolean matrix [number of alignments x max genome length], a row per sequence that is updated in place
+        #True marks a deleted nucleotide
+        deleted_nucleotides = np.zeros((self.numberOfSeqs, self.maxGenomeLength), dtype=bool)
         parents_minor = {}            
         parents_major = {} 
     
@@ -486,158 +684,143 @@ class classifier:
         #then that recombinant region is added to deleted nucleotides. Since all future events will have a smaller event number (earlier generation),
         #these nucleotides shouldnt be considered for any parent calculations.
         for event_number, sequence_ranges_dict in reversed(block_dict.items()):
+            parents_minor[event_number], parents_major[event_number] = self.scoreEvent(event_number, sequence_ranges_dict, deleted_nucleotides)
 
-            #divide sequences into recombinant and potential parents
-            sequences_in_block = set(sequence_ranges_dict.keys())
-            sequences_not_in_block = set(range(self.numberOfSeqs)) - sequences_in_block      
-            best_parents_minor = []
-            best_parents_major = []
-
-            #calculate best parents for all sequences of the current recombination event
-            for sequence, ranges in sequence_ranges_dict.items():  
-                recombinant_seq = str(self.alignment[str(sequence+1)])  
-                hamming_distances_major = {}
-                hamming_distances_minor = {}   
-
-                #calculate scores for all potential parents
-                for parent in sequences_not_in_block:
-                    parent_seq = str(self.alignment[str(parent+1)])
-                    hamming_distance_both = self.findDistanceScores(parent, ranges, deleted_nucleotides, parent_seq, recombinant_seq, event_number)    
-                    hamming_distances_minor[parent] = hamming_distance_both[0]                   
-                    hamming_distances_major[parent] = hamming_distance_both[1]  
-
-                #find best parents:
-                best_parents_score = self.findBestParentPair(hamming_distances_minor, hamming_distances_major) 
-                best_parents = best_parents_score[0]
-                best_score = best_parents_score[1]           
-
-                #if a viable best parent pair could be found, add to list
-                if best_parents:   
-                    best_minor_parent = ''
-                    best_major_parent = ''
-
-                    if isinstance(best_parents[0], int):
-                        best_minor_parent = str(best_parents[0]+1)
-                    else:
-                        best_minor_parent = best_parents[0]
-                    if isinstance(best_parents[1], int):
-                        best_major_parent = str(best_parents[1]+1)
-                    else:
-                        best_major_parent = best_parents[1]
-
-                    best_parents_minor.append((sequence+1, best_minor_parent, best_score))
-                    best_parents_major.append((sequence+1, best_major_parent, best_score))                 
-             
-                #now add the nucleotides we have traversed to deleted nucleotides, these won't be considered in future events
-                if sequence in deleted_nucleotides.keys():                                                            
-                    deleted_nucleotides[sequence] = deleted_nucleotides[sequence].union(IntervalTree.from_tuples(ranges))                     
-                    deleted_nucleotides[sequence].merge_overlaps()
-                else:
-                    deleted_nucleotides[sequence] = IntervalTree.from_tuples(ranges)               
+            #now add the nucleotides we have traversed to deleted nucleotides, these won't be considered in future events
+            for sequence, ranges in sequence_ranges_dict.items():
+                for start, end in ranges:
+                    deleted_nucleotides[sequence, start:end] = True
 
-            parents_minor[event_number] = best_parents_minor
-            parents_major[event_number] = best_parents_major                          
+        self.minor_parents = parents_minor
+        self.major_parents = parents_major        
+
+    def calculateParentsParallel(self, block_dict):
+        #same traversal as calculateParents, but the events are cut into layers of consecutive events and
+        #every event of a layer is scored at the same time by a pool of event workers
+        #the alignment, gap mask and deleted nucleotides live in shared memory, so workers don't receive copies of them
+        #an event still has to skip the nucleotides of the events before it in its own layer, those ranges are sent along with it (pending),
+        #and the deleted nucleotides are merged once the whole layer is done. The results are identical to calculateParents.
+        events = list(reversed(block_dict.items()))
+        layer_size = self.layerSize or 4 * self.eventWorkers
+        parents_minor = {}            
+        parents_major = {} 
+
+        memory = {}
+        try:
+            memory['alignment'], _ = share_array(self.alignment)
+            memory['gaps'], _ = share_array(self.gaps)
+            memory['deletedNucleotides'], deleted_nucleotides = share_array(np.zeros((self.numberOfSeqs, self.maxGenomeLength), dtype=bool))
+
+            shared = {attr: (memory[attr].name, shape, dtype) for attr, shape, dtype in (
+                ('alignment', self.alignment.shape, self.alignment.dtype),
+                ('gaps', self.gaps.shape, self.gaps.dtype),
+                ('deletedNucleotides', deleted_nucleotides.shape, deleted_nucleotides.dtype))}
+            state = {'events_dict': self.events_dict, 'maxGenomeLength': self.maxGenomeLength, 'numberOfSeqs': self.numberOfSeqs,
+                     'breakpointWindow': self.breakpointWindow, 'metrics': type(self.metrics)(),
+                     'backend': self.backend}
+
+            with Pool(self.eventWorkers, initializer=init_event_worker, initargs=(state, shared)) as pool:
+                for lo in range(0, len(events), layer_size):
+                    layer = events[lo:lo+layer_size]
+                    tasks = [(event_number, sequence_ranges_dict, [ranges_dict for _, ranges_dict in layer[:k]])
+                             for k, (event_number, sequence_ranges_dict) in enumerate(layer)]
+
+                    for (event_number, sequence_ranges_dict), (best_parents, counters) in zip(layer, pool.map(score_event, tasks, chunksize=1)):
+                        parents_minor[event_number], parents_major[event_number] = best_parents
+                        self.metrics.merge(counters)
+
+                    #merge the layer into the shared deleted nucleotides before the next layer starts
+                    for event_number, sequence_ranges_dict in layer:
+                        for sequence, ranges in sequence_ranges_dict.items():
+                            for start, end in ranges:
+                                deleted_nucleotides[sequence, start:end] = True
+        finally:
+            deleted_nucleotides = None
+            for block in memory.values():
+                block.close()
+                block.unlink()
 
         self.minor_parents = parents_minor
         self.major_parents = parents_major        
 
     def calcParents(self):
         #This function uses the generation matrix to calculate the best minor and major parents for each recombination event
+        #parents() runs it once and keeps the result, calling it directly recalculates
+        self.prepare()
 
         #we need to know where the "recombination event blocks" are, i.e. which sections of the alignment to compare to find parents
         #will make a dictionary to store this information, see function for more details on dictionary
-        block_dict = self.findEventPositions()                
+        with self.metrics.stage('findEventPositions'):
+            block_dict = self.findEventPositions()                
         #now we can use this dictionary to find the major parents              
-        self.calculateParents(block_dict)  
+        with self.metrics.stage('calculateParents'):
+            if self.eventWorkers > 1:
+                self.calculateParentsParallel(block_dict)
+            else:
+                self.calculateParents(block_dict)  
+        self.metrics.count('events', len(block_dict))
+        self.metrics.count('recombinants', sum(len(sequence_ranges_dict) for sequence_ranges_dict in block_dict.values()))
       
-    def output(self):  
-        # Create unique key for the file name
-        key = re.search(r'(?<=alignment_).*', self.alignment_path.name).group()[:-3]
-        fileName = ("output/RPD_Output_" + key + '.rdp5ML')
-        filePath = Path(fileName)
+    def output(self, outputDir=None):  
+        # Writes the parents to <outputDir>/RPD_Output_<key>.rdp5ML, outputDir defaults to the one the classifier was made with
+        # Tab separated with CRLF line endings, as read by RDP_pipeline.py. Runs the earlier stages if needed, returns the file path
+        outputDir = Path(outputDir if outputDir is not None else self.outputDir)
+
+        filePath = output_path(self.alignment_path, outputDir)
         
-        try:
-            os.makedirs('output')
-        except FileExistsError:
-            pass      
+        os.makedirs(outputDir, exist_ok=True)
         
-        with open(fileName, "w", newline = '\r\n') as g:
-            header = ['SantaEventNumber', 'StartBP', 'EndBP', 'Recombinant', 'MinorParent', 'MajorParent', 'Score'] 
-            g.write('\t'.join(str(s) for s in header) + '\n')
-
-        for events in self.minor_parents.keys():
-            startBP, EndBP = self.events_dict[events]
-            for minorTup, MajorTup in zip(self.minor_parents[events], self.major_parents[events]):
-                recom = minorTup[0]
-                minor = minorTup[1]
-                major = MajorTup[1]
-                score = minorTup[2]
-                
-                with open(fileName, "a", newline = '\r\n') as f:
-                    content = [events, startBP, EndBP, recom, minor, major, score]
-                    f.write('\t'.join(str(s) for s in content) + '\n')        
-
-#### Unused ####
-# def getFilePaths():
-#     # This function is used to get the folder path from command line.
-#     # For future pipeline use.
-
-#     # Define command line argument parser
-#     parser = argparse.ArgumentParser(
-#         description="Parse Recombination Information from SantaSim"
-#     )
-
-#     # Add arguments for command line
-#     parser.add_argument(
-#         "-a",
-#         dest="alignment_path",
-#         type=str,
-#         help="recombination events file",
-#         required=True,
-#     )
-#     parser.add_argument(
-#         "-f",
-#         dest="recombination_path",
-#         type=str,
-#         help="recombination events file",
-#         required=True,
-#     )
-#     parser.add_argument(
-#         "-f",
-#         dest="sequence_path",
-#         type=str,
-#         help="sequence events map file",
-#         required=True,
-#     )
-
-#     # Parse Events
-#     args = parser.parse_args()
-
-#     # Returns the root folder to parse
-#     return (args.alignment_path, args.recombination_path, args.sequence_path)
-
-
-#if __name__ == "__main__":
-
-    # Using the file as a class from the module in the pipeline script. 
-    # This section isn't necessary but leaving in for now. 
-    # print('Im main')
-
-    # The line below will be used to get fileNames from pipeline later
-    # alignment_path, recombination_path, sequence_path = getFilePaths()
-
-    # Currently used for testing purposes.
-    #alignment_path = "data/alignment_XML1-2500-0.01-12E-5-100-13.fa"
-    #recombination_path = "data/recombination_events_XML1-2500-0.01-12E-5-100-13.txt"
-    #sequence_path = "data/sequence_events_map_XML1-2500-0.01-12E-5-100-13.txt"
-
-    # Create classifier class by initialising file paths
-    #parser = classifier(alignment_path, recombination_path, sequence_path)
-
-    # XML1-2500-0.01-12E-5-100-13
-    # XML1-4000-0.005-8E-5-200-6
-    # XML5-4000-0.02-12E-5-50-4-3   
-
-    # data/tiny_test.fa
-    # data/tiny_test_revents.txt
-    # data/tiny_test_map.txt
\ No newline at end of file
+        # One buffered handle for the header and every row
+        # the file is renamed into place once complete, so an existing .rdp5ML is never a partial one
+        rows = self.parents()
+        partPath = filePath.with_name(filePath.name + '.part')
+        with self.metrics.stage('output'), open(partPath, "w", newline = '\r\n', buffering = 1 << 20) as g:
+            g.write('\t'.join(str(s) for s in OUTPUT_COLUMNS) + '\n')
+
+            for content in rows:
+                g.write('\t'.join(str(s) for s in content) + '\n')
+        os.replace(partPath, filePath)
+
+        return filePath
+
+def getFilePaths():
+    # This function is used to get the file paths from command line, for running a single alignment.
+
+    # Define command line argument parser
+    parser = argparse.ArgumentParser(
+        description="Parse Recombination Information from SantaSim"
+    )
+
+    # Add arguments for command line
+    parser.add_argument("-a", dest="alignment_path", type=str, help="alignment file", required=True)
+    parser.add_argument("-r", dest="recombination_path", type=str, help="recombination events file", required=True)
+    parser.add_argument("-s", dest="sequence_path", type=str, help="sequence events map file", required=True)
+    parser.add_argument("-w", dest="workers", type=int, default=1, help="processes used to score the events of the alignment")
+    parser.add_argument("-l", dest="layer_size", type=int, default=None, help="events per parallel layer, default 4 per worker")
+    parser.add_argument("-o", dest="output_dir", type=str, default="output", help="folder the .rdp5ML file is written to")
+    parser.add_argument("-b", dest="window", type=int, default=200, help="nucleotides either side of a breakpoint that are weighted 2x")
+    parser.add_argument("-c", dest="cache", action="store_true", help="reuse or store the preprocessed inputs in a cache")
+    parser.add_argument("-d", dest="cache_dir", type=str, default=None, help="cache folder, default classifier_cache/ next to the alignment")
+    parser.add_argument("-p", dest="metrics_path", type=str, default=None, help="JSON lines file the stage metrics are appended to")
+    parser.add_argument("-e", dest="backend", type=str, default="auto", choices=classifier_kernels.BACKENDS, help="kernels for the distance scoring")
+
+    # Parse Events
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    # Runs one alignment from the command line, the pipeline script imports the class instead.
+    # Large alignments can use -w to score the events of the file on several cores.
+    # e.g. python event_classifier.py -a data/alignment_XML1-2500-0.01-12E-5-100-13.fa
+    #        -r data/recombination_events_XML1-2500-0.01-12E-5-100-13.txt -s data/sequence_events_map_XML1-2500-0.01-12E-5-100-13.txt -w 8
+    args = getFilePaths()
+
+    # Create classifier class by initialising file paths, then run every stage and write the .rdp5ML file
+    parser = classifier(args.alignment_path, args.recombination_path, args.sequence_path,
+                        eventWorkers=args.workers, layerSize=args.layer_size, outputDir=args.output_dir,
+                        breakpointWindow=args.window, cache=args.cache, cacheDir=args.cache_dir,
+                        metrics=args.metrics_path is not None, backend=args.backend)
+    parser.output()
+    if args.metrics_path is not None:
+        classifier_metrics.write_record(args.metrics_path, parser.metricsRecord())
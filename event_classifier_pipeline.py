@@ -1,12 +1,25 @@
 import os
 from pathlib import Path, Path
 import event_classifier
+import classifier_cache
+import classifier_manifest
+import classifier_metrics
+import json
 import re
 import gc
-from multiprocessing import Pool
+import time
+import argparse
+import signal
+import traceback
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
 
 alignment_files = []
 
+# Written to the output folder when the batch runs with metrics: one JSON line per alignment, and their summary
+METRICS_NAME = 'classifier_metrics.jsonl'
+METRICS_SUMMARY_NAME = 'classifier_metrics_summary.json'
+
 def getFileNames(folderToParse = ''):
     # Walk through the folder and find all recombination event files, sequence event files and
     # alignment files and store them in lists.
@@ -22,23 +35,100 @@ def getFileNames(folderToParse = ''):
             if files.endswith('.fa'):
                 alignment_files.append(
                     Path(paths[0] + '/' + files))
-    
-def parsing_loop(alig):
-    # total = len(alignment_files)
 
-    # for count, alig in enumerate(alignment_files):
+def companionFiles(alig):
+    # The recombination events and sequence events map files that belong to an alignment
     key = re.search(r'(?<=alignment_).*', alig.name).group()[:-3]
     rec = Path(alig.parents[0] / ('recombination_events_' + key + '.txt'))
     seq = Path(alig.parents[0] / ('sequence_events_map_' + key + '.txt'))
+    return rec, seq
+
+def countLines(path):
+    # Number of lines in a file, counted in binary blocks without decoding
+    with open(path, 'rb') as f:
+        return sum(block.count(b'\n') for block in iter(lambda: f.read(1 << 20), b''))
+
+def estimateCost(alig):
+    # Relative cost of classifying an alignment, used to order the batch
+    # every event compares its recombinants against all the other sequences over the whole genome,
+    # so the cost grows with the alignment size (sequences x genome length) times the number of events
+    # returns (cost, sequences, events), the files hold a header line and then one line per sequence or event
+    rec, seq = companionFiles(alig)
+    sequences = max(countLines(seq) - 1, 1)
+    events = max(countLines(rec) - 1, 1)
+    return (os.path.getsize(alig) * events, sequences, events)
+
+def isDone(alig, outputDir, manifest):
+    # True if the alignment has its .rdp5ML and the manifest says it was made from the current input files
+    # outputs written before the batch kept a manifest count as done, changed inputs are found from their stamp and then hash
+    if not event_classifier.output_path(alig, outputDir).exists():
+        return False
+    row = manifest.get(alig)
+    if row is None:
+        return True
+    if row['status'] != classifier_manifest.DONE:
+        return False
+
+    rec, seq = companionFiles(alig)
+    stamp = classifier_manifest.input_stamp(alig, rec, seq)
+    if stamp == row['input_stamp']:
+        return True
+    if classifier_cache.input_key(alig, rec, seq) == row['input_hash']:
+        manifest.restamp(alig, stamp)
+        return True
+    return False
+
+def schedule(files, outputDir, manifest):
+    # Orders a batch for the workers, largest estimated cost first so the big alignments don't start last
+    # alignments that are done (see isDone) are left out, which resumes an interrupted batch
+    # returns (jobs, skipped), jobs is a list of (alignment, cost)
+    jobs = []
+    skipped = []
+    for alig in files:
+        if isDone(alig, outputDir, manifest):
+            skipped.append(alig)
+            continue
+        rec, seq = companionFiles(alig)
+        cost = estimateCost(alig)[0] if rec.exists() and seq.exists() else 0
+        jobs.append((alig, cost))
+
+    jobs.sort(key=lambda job: job[1], reverse=True)
+    return jobs, skipped
+
+def canLimitMemory():
+    # True where the address space of a worker can be capped, which needs RLIMIT_AS of the Unix-only resource module
+    try:
+        import resource
+    except ImportError:
+        return False
+    return hasattr(resource, 'RLIMIT_AS')
+
+def limitMemory(memoryCap):
+    # Run first in every worker, caps the address space of a worker at memoryCap MB so one huge alignment
+    # raises a MemoryError in its own worker instead of pushing the node into swap
+    # run_batch checks canLimitMemory before it starts a worker with a cap
+    if memoryCap:
+        import resource
+        limit = int(memoryCap) << 20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def parsing_loop(alig, outputDir='output', metrics=False):
+    # total = len(alignment_files)
+
+    # for count, alig in enumerate(alignment_files):
+    rec, seq = companionFiles(alig)
 
     if alig.exists() and rec.exists() and seq.exists():
         # print(f'Parsing {count+1} out of {total}.')
-        parse = event_classifier.classifier(alig, rec, seq)
-        
+        parse = event_classifier.classifier(alig, rec, seq, outputDir=outputDir, metrics=metrics)
+        parse.output()
+        record = parse.metricsRecord()
+
         #Remove parse after use and create new.
         del parse
         gc.collect()
-        
+        return record
+
     else:
         print("The requested files don't exist")
         print('Alig: ' + str(alig.exists()))
@@ -46,10 +136,155 @@ def parsing_loop(alig):
         print('Seq: ' + str(seq.exists()))
         pass
 
+def run_job(job):
+    # Runs one scheduled alignment in its worker process
+    # returns a dict with the alignment, its cost, the stamp and hash of its inputs, the wall time, how far the alignment raised
+    # the peak RSS of the worker in MB and the error (None on success). Any exception is reported back rather than stopping the batch
+    alig, cost, outputDir, metrics = job
+    result = {'alig': alig, 'cost': cost, 'stamp': None, 'inputHash': None, 'error': None, 'metrics': None}
+    start = time.perf_counter()
+    # a forked worker starts out with the peak RSS of the batch process, so only the growth above it belongs to this alignment
+    startPeak = classifier_metrics.peak_rss_mb()
+    try:
+        rec, seq = companionFiles(alig)
+        if not (alig.exists() and rec.exists() and seq.exists()):
+            raise FileNotFoundError(f'Missing input files for {alig.name}: rec {rec.exists()}, seq {seq.exists()}')
+        result['stamp'] = classifier_manifest.input_stamp(alig, rec, seq)
+        result['inputHash'] = classifier_cache.input_key(alig, rec, seq)
+        result['metrics'] = parsing_loop(alig, outputDir, metrics)
+    except MemoryError:
+        result['error'] = 'MemoryError: out of memory'
+    except Exception:
+        result['error'] = traceback.format_exc()
+    gc.collect()
+
+    result['seconds'] = time.perf_counter() - start
+    # None where the platform has no resource module
+    result['peakRss'] = None if startPeak is None else classifier_metrics.peak_rss_mb() - startPeak
+    return result
+
+def job_process(job, memoryCap, conn):
+    # Body of the worker process of one alignment, sends the result of run_job back through conn
+    limitMemory(memoryCap)
+    conn.send(run_job(job))
+    conn.close()
+
+def lost_result(job, exitcode, seconds):
+    # The result of an alignment whose worker ended without sending one back,
+    # e.g. killed by the OOM killer or by a segfault in a compiled kernel
+    alig, cost, _, _ = job
+    if exitcode is not None and exitcode < 0:
+        reason = f'was killed by signal {-exitcode} ({signal.strsignal(-exitcode)})'
+    else:
+        reason = f'exited with code {exitcode}'
+    return {'alig': alig, 'cost': cost, 'stamp': None, 'inputHash': None, 'metrics': None, 'seconds': seconds, 'peakRss': None,
+            'error': f'WorkerDied: the worker process {reason} without a result'}
+
+def run_jobs(jobs, manifest, workers=None, memoryCap=None, outputDir='output', metrics=False):
+    # Runs a list of (alignment, cost) jobs on workers processes and records every outcome in the manifest
+    # with metrics the record of every finished alignment is appended to METRICS_NAME
+    # each alignment runs in a process of its own, so a crash or a leak can't carry over to the next one, and a worker
+    # that dies without a result (OOM killer, segfault, SIGKILL) fails only its own alignment while the rest carry on
+    # progress and throughput are printed as each alignment finishes, returns the jobs that failed
+    totalCost = sum(cost for _, cost in jobs) or 1
+    doneCost = 0
+    failed = []
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+
+    for alig, _ in jobs:
+        manifest.start(alig)
+
+    tasks = [(alig, cost, outputDir, metrics) for alig, cost in jobs]
+    # the receiving end of each running worker's pipe -> (process, job, start time)
+    running = {}
+    count = 0
+    try:
+        while tasks or running:
+            while tasks and len(running) < workers:
+                job = tasks.pop(0)
+                receiver, sender = Pipe(duplex=False)
+                process = Process(target=job_process, args=(job, memoryCap, sender), daemon=True)
+                process.start()
+                # only the worker holds the sending end, so the pipe reads as closed as soon as the worker is gone
+                sender.close()
+                running[receiver] = (process, job, time.perf_counter())
+
+            for receiver in wait(list(running)):
+                process, job, jobStart = running.pop(receiver)
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    result = None
+                receiver.close()
+                process.join()
+                if result is None:
+                    result = lost_result(job, process.exitcode, time.perf_counter() - jobStart)
+
+                count += 1
+                alig, error = result['alig'], result['error']
+                manifest.finish(alig, classifier_manifest.FAILED if error else classifier_manifest.DONE,
+                                stamp=result['stamp'], inputHash=result['inputHash'], wallTime=result['seconds'],
+                                peakRss=result['peakRss'], error=error)
+                if error:
+                    failed.append((alig, result['cost']))
+                elif result['metrics'] is not None:
+                    classifier_metrics.write_record(Path(outputDir) / METRICS_NAME, result['metrics'])
+
+                doneCost += result['cost']
+                elapsed = time.perf_counter() - start
+                status = f"failed, {error.strip().splitlines()[-1]}" if error else f"{result['seconds']:.1f}s, +{classifier_metrics.format_mb(result['peakRss'])} MB"
+                print(f'{count}/{len(jobs)} {alig.name} ({status}) | {count / elapsed * 60:.1f} alignments/min, '
+                      f'{doneCost / totalCost:.0%} of the estimated work in {elapsed:.0f}s')
+    finally:
+        # on an interrupt the workers still running are stopped, their alignments stay running in the manifest
+        for process, _, _ in running.values():
+            process.terminate()
+            process.join()
+
+    return failed
+
+def run_batch(files, workers=None, memoryCap=None, outputDir='output', retries=1, metrics=False):
+    # Classifies a batch of alignments, largest first, one alignment per task so no worker waits on a queued chunk
+    # the manifest in outputDir records every alignment, done ones are skipped when the batch is run again
+    # and failed ones are retried up to retries more times, each attempt in a fresh worker
+    # with metrics every stage of every alignment is timed, and the records in outputDir are summarised at the end
+    if memoryCap and not canLimitMemory():
+        raise OSError("A memory cap (-m) needs resource.RLIMIT_AS, which this platform doesn't have, run the batch without -m")
+
+    manifest = classifier_manifest.Manifest(Path(outputDir) / classifier_manifest.MANIFEST_NAME)
+    try:
+        jobs, skipped = schedule([Path(alig).resolve() for alig in files], outputDir, manifest)
+        if skipped:
+            print(f'Skipping {len(skipped)} alignments that already have output.')
+
+        for attempt in range(retries + 1):
+            if not jobs:
+                break
+            if attempt:
+                print(f'Retrying {len(jobs)} failed alignments, attempt {attempt + 1} of {retries + 1}.')
+            jobs = run_jobs(jobs, manifest, workers, memoryCap, outputDir, metrics)
+
+        print(', '.join(f'{count} {status}' for status, count in sorted(manifest.summary().items())))
+        if metrics and (Path(outputDir) / METRICS_NAME).exists():
+            summary = classifier_metrics.summarise(classifier_metrics.read_records(Path(outputDir) / METRICS_NAME))
+            with open(Path(outputDir) / METRICS_SUMMARY_NAME, 'w') as f:
+                json.dump(summary, f, indent=2)
+            print(classifier_metrics.format_summary(summary))
+    finally:
+        manifest.close()
+
 
 if __name__ == '__main__':
-    # Change the path below to your target path.
-    getFileNames(folderToParse=Path(r'dataRaw/Test'))
-    with Pool() as p:
-        p.map(parsing_loop, alignment_files)
-    
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the event classifier over every alignment in a folder")
+    parser.add_argument("-f", dest="folder", type=str, default='dataRaw/Test', help="folder searched for alignment_*.fa files")
+    parser.add_argument("-w", dest="workers", type=int, default=None, help="worker processes, default one per core")
+    parser.add_argument("-m", dest="memory_cap", type=int, default=None, help="memory cap per worker in MB")
+    parser.add_argument("-o", dest="output_dir", type=str, default="output", help="folder the .rdp5ML files and the manifest are written to")
+    parser.add_argument("-r", dest="retries", type=int, default=1, help="times a failed alignment is retried")
+    parser.add_argument("-p", dest="metrics", action="store_true", help="record stage metrics for every alignment")
+    args = parser.parse_args()
+
+    getFileNames(folderToParse=Path(args.folder))
+    run_batch(alignment_files, workers=args.workers, memoryCap=args.memory_cap, outputDir=args.output_dir, retries=args.retries,
+              metrics=args.metrics)
@@ -0,0 +1,180 @@
+# Columnar store of the machine learning dataset written by output_parser (the ml_input_*.txt files).
+# Each input file becomes a partition: one float32 .npy per RDP statistic and an int8 .npy for is_recombinant,
+# so a training job memory-maps the columns it needs instead of parsing the CSVs again every session.
+# store.json holds the metadata: the columns, the partitions with their row counts, the triplet size and the splits.
+# A split (Train, Test, Unseen, ...) is a list of [partition, start, stop) row ranges, so splitting copies nothing.
+# e.g. python feature_store.py -o feature_store -i output_test/ml_input_XML-*.txt -u output_test/ml_input_UnseenTestSet.txt -t 10002
+#      X, y = feature_store.load_arrays('feature_store', split='Train')
+
+import argparse
+import json
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# Bump when the layout of a store changes
+STORE_VERSION = 1
+METADATA_NAME = 'store.json'
+
+LABEL = 'is_recombinant'
+
+# Rows of one triplet, splits never cut through a triplet
+TRIPLET = 3
+
+def read_metadata(folder):
+    # The metadata of a store, or an empty store if there is none yet
+    path = Path(folder) / METADATA_NAME
+    if not path.exists():
+        return {'version': STORE_VERSION, 'label': LABEL, 'rows_per_triplet': TRIPLET, 'columns': None, 'partitions': {}, 'splits': {}}
+    metadata = json.loads(path.read_text())
+    if metadata['version'] != STORE_VERSION:
+        raise ValueError(f"{path} is a version {metadata['version']} store, expected version {STORE_VERSION}")
+    return metadata
+
+def write_metadata(folder, metadata):
+    # Written to a temporary file and renamed into place, so a reader never sees half of it
+    path = Path(folder) / METADATA_NAME
+    temp = path.with_suffix('.tmp' + str(os.getpid()))
+    temp.write_text(json.dumps(metadata, indent=2))
+    os.replace(temp, path)
+
+def column_file(index):
+    # Column names are RDP statistic headers, so the files are numbered and store.json maps names to numbers
+    return f'c{index:04d}.npy'
+
+def write_partition(folder, name, df, source=None):
+    # Stores a DataFrame as partition name, replacing an older partition of that name
+    # every column must be numeric, the statistics are stored as float32 (NaN stays NaN) and the label as int8
+    # the first partition fixes the columns of the store, later ones must have the same
+    folder = Path(folder)
+    os.makedirs(folder, exist_ok=True)
+    metadata = read_metadata(folder)
+
+    if len(df) % TRIPLET:
+        raise ValueError(f"Partition {name} has {len(df)} rows, not whole triplets of {TRIPLET}")
+    columns = [str(c) for c in df.columns]
+    if LABEL not in columns:
+        raise ValueError(f"Partition {name} has no {LABEL} column")
+    if metadata['columns'] is None:
+        metadata['columns'] = {c: ('int8' if c == LABEL else 'float32') for c in columns}
+    elif sorted(columns) != sorted(metadata['columns']):
+        raise ValueError(f"The columns of partition {name} differ from the columns of the store")
+
+    # the partition is written to a temporary folder and renamed into place
+    partition = folder / name
+    temp = folder / (name + '.tmp' + str(os.getpid()))
+    os.makedirs(temp, exist_ok=True)
+    try:
+        for index, (column, dtype) in enumerate(metadata['columns'].items()):
+            np.save(temp / column_file(index), df[column].to_numpy(dtype=dtype))
+        shutil.rmtree(partition, ignore_errors=True)
+        os.replace(temp, partition)
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+
+    metadata['partitions'][name] = {'rows': len(df), 'triplets': len(df) // TRIPLET, 'source': str(source) if source else None}
+    # the row ranges of splits over the old partition no longer hold
+    metadata['splits'] = {split: ranges for split, ranges in metadata['splits'].items() if all(r[0] != name for r in ranges)}
+    write_metadata(folder, metadata)
+    return partition
+
+def set_split(folder, split, ranges):
+    # Stores split as a list of (partition, start, stop) row ranges, which must cover whole triplets
+    metadata = read_metadata(folder)
+    for partition, start, stop in ranges:
+        rows = metadata['partitions'][partition]['rows']
+        if not (0 <= start <= stop <= rows) or start % TRIPLET or stop % TRIPLET:
+            raise ValueError(f"Range [{start}, {stop}) of {partition} isn't whole triplets within its {rows} rows")
+    metadata['splits'][split] = [[partition, int(start), int(stop)] for partition, start, stop in ranges]
+    write_metadata(folder, metadata)
+
+def split_tail(folder, partitions, test_rows, names=('Train', 'Test')):
+    # Splits the concatenation of partitions into its first rows and its last test_rows rows, in order,
+    # like train_test_split(..., test_size=test_rows, shuffle=False) on the concatenated CSVs
+    metadata = read_metadata(folder)
+    total = sum(metadata['partitions'][p]['rows'] for p in partitions)
+    boundary = total - test_rows
+    head, tail = [], []
+    offset = 0
+    for partition in partitions:
+        rows = metadata['partitions'][partition]['rows']
+        cut = min(max(boundary - offset, 0), rows)
+        if cut > 0:
+            head.append((partition, 0, cut))
+        if cut < rows:
+            tail.append((partition, cut, rows))
+        offset += rows
+    set_split(folder, names[0], head)
+    set_split(folder, names[1], tail)
+
+def ranges_of(metadata, split=None, partitions=None):
+    # The row ranges to load: a split, some partitions, or every partition
+    if split is not None:
+        return metadata['splits'][split]
+    names = partitions if partitions is not None else list(metadata['partitions'])
+    return [[name, 0, metadata['partitions'][name]['rows']] for name in names]
+
+def load_columns(folder, columns=None, split=None, partitions=None, mmap_mode='r'):
+    # Returns {column: array} for columns (default all) of a split or of partitions (default all)
+    # a range that is a single partition comes back as a read-only memory-map slice, no copy and no parsing,
+    # several ranges are concatenated
+    folder = Path(folder)
+    metadata = read_metadata(folder)
+    names = list(metadata['columns'])
+    columns = names if columns is None else list(columns)
+    ranges = ranges_of(metadata, split, partitions)
+
+    arrays = {}
+    for column in columns:
+        parts = [np.load(folder / partition / column_file(names.index(column)), mmap_mode=mmap_mode)[start:stop]
+                 for partition, start, stop in ranges]
+        if len(parts) == 1:
+            arrays[column] = parts[0]
+        else:
+            arrays[column] = np.concatenate(parts) if parts else np.zeros(0, dtype=metadata['columns'][column])
+    return arrays
+
+def load_frame(folder, columns=None, split=None, partitions=None):
+    # load_columns as a DataFrame in the column order of the ml_input files
+    return pd.DataFrame(load_columns(folder, columns, split, partitions))
+
+def load_arrays(folder, columns=None, split=None, partitions=None, triplets=False):
+    # The features and labels for training: X [rows x features] float32 and y [rows] int8
+    # columns defaults to every statistic, with triplets=True X is [triplets x 3 x features] and y [triplets x 3]
+    metadata = read_metadata(folder)
+    features = [c for c in metadata['columns'] if c != LABEL] if columns is None else [c for c in columns if c != LABEL]
+    arrays = load_columns(folder, features + [LABEL], split, partitions)
+    X = np.stack([arrays[c] for c in features], axis=1)
+    y = np.asarray(arrays[LABEL])
+    if triplets:
+        return X.reshape(-1, TRIPLET, len(features)), y.reshape(-1, TRIPLET)
+    return X, y
+
+def build(folder, inputs, unseen=(), test_rows=0):
+    # Builds a store from ml_input files: every file is a partition named after its ml_input_<name>.txt,
+    # the inputs make the Train and Test splits (the last test_rows rows are Test) and the unseen files the Unseen split
+    # the ISeqs(A) column is dropped if a file still has it
+    def partition_name(path):
+        name = Path(path).stem
+        return name[len('ml_input_'):] if name.startswith('ml_input_') else name
+
+    for path in list(inputs) + list(unseen):
+        df = pd.read_csv(path, sep=',', index_col=False)
+        write_partition(folder, partition_name(path), df.drop(columns=['ISeqs(A)'], errors='ignore'), source=path)
+        print(f'Stored {path}: {len(df)} rows')
+
+    split_tail(folder, [partition_name(p) for p in inputs], test_rows)
+    if unseen:
+        set_split(folder, 'Unseen', ranges_of(read_metadata(folder), partitions=[partition_name(p) for p in unseen]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build a columnar feature store from ml_input files")
+    parser.add_argument("-o", dest="folder", type=str, default='feature_store', help="folder of the store")
+    parser.add_argument("-i", dest="inputs", nargs='+', required=True, help="ml_input files of the Train and Test splits, in order")
+    parser.add_argument("-u", dest="unseen", nargs='*', default=[], help="ml_input files of the Unseen split")
+    parser.add_argument("-t", dest="test_rows", type=int, default=0, help="rows at the end of the inputs that form the Test split")
+    args = parser.parse_args()
+
+    build(args.folder, args.inputs, args.unseen, args.test_rows)
@@ -1,13 +1,27 @@
 import os
 import re
 import argparse
+import numpy as np
 import pandas as pd
 from pathlib import Path, Path
+from multiprocessing import Pool
+
+# Optional, only needed for the columnar copy of the dataset
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 
 rdpStatsFiles = []
 rdpSimVReal = []
 
+# Suffixes of the two RDP5 outputs of an alignment, what comes before them is the key that pairs them
+STATS_SUFFIX = '.faRecombIdentifyStats.csv'
+COMPARE_SUFFIX = '.faSimVSRealCompare.csv'
+
 def getFileNames(folderToParse = ''):
     # Walk through the folder and find all recombination event files, sequence event files and
     # alignment files and store them in lists.
@@ -20,44 +34,74 @@ def getFileNames(folderToParse = ''):
     # If matching add to the relavent list as type Path
     for paths in os.walk(targetFolder):
         for files in paths[2]:
-            if files.endswith('.faRecombIdentifyStats.csv'):
+            if files.endswith(STATS_SUFFIX):
                 rdpStatsFiles.append(
                     Path(paths[0] + '/' + files))
-            if files.endswith('.faSimVSRealCompare.csv'):
+            if files.endswith(COMPARE_SUFFIX):
                 rdpSimVReal.append(
                     Path(paths[0] + '/' + files))
 
-def validate_and_clean_triplets(processed_df, rdpFiles):
+def pairFiles(statsFiles, compareFiles):
     """
-    Validate triplets and remove those with more than one recombinant.
+    Pair every RecombIdentifyStats file with the SimVSRealCompare file of the same alignment,
+    matched on their folder and the file name before the suffix rather than on list position.
+    
+    Parameters:
+    statsFiles (list): Paths of the RecombIdentifyStats files
+    compareFiles (list): Paths of the SimVSRealCompare files
+    
+    Returns:
+    list: (stats path, compare path) tuples in the order of statsFiles
+    list: The files of either list that have no partner
+    """
+    def key(path, suffix):
+        return (path.parent, path.name[:-len(suffix)])
+    
+    compare = {key(path, COMPARE_SUFFIX): path for path in compareFiles}
+    pairs = [(path, compare.pop(key(path, STATS_SUFFIX))) for path in statsFiles if key(path, STATS_SUFFIX) in compare]
+    paired = {stats for stats, _ in pairs}
+    unpaired = [path for path in statsFiles if path not in paired] + list(compare.values())
+    
+    return pairs, unpaired
+
+def validate_and_clean_triplets(processed_df, rdpFiles=None, report=False):
+    """
+    Validate triplets and remove those without exactly one recombinant.
+    Every three rows form a triplet, a trailing incomplete triplet is always removed.
     
     Parameters:
     processed_df (pandas.DataFrame): The processed DataFrame
+    rdpFiles (tuple): The files the data came from, named in the removal message
+    report (bool): Also return the removed triplets
     
     Returns:
     pandas.DataFrame: Cleaned DataFrame with invalid triplets removed
     dict: Statistics about the cleaning process
+    pandas.DataFrame: Only with report, the first row and the number of recombinants of every removed triplet
     """
-    rows_to_keep = []
+    # Recombinants per triplet in one pass, the last segment of reduceat runs to the end of a short final triplet
+    labels = processed_df['is_recombinant'].to_numpy()
+    first_rows = np.arange(0, len(labels), 3)
+    recomb_counts = np.add.reduceat(labels, first_rows) if len(labels) else np.zeros(0, dtype=np.int64)
+    keep = recomb_counts == 1
+    if len(labels) % 3:
+        keep[-1] = False
+    
+    cleaned_df = processed_df.iloc[np.flatnonzero(np.repeat(keep, 3)[:len(labels)])].copy()
     stats = {
         'original_triplets': len(processed_df) // 3,
-        'removed_triplets': 0,
-        'remaining_triplets': 0
+        'removed_triplets': int((~keep).sum()),
+        'remaining_triplets': len(cleaned_df) // 3
     }
     
-    for i in range(0, len(processed_df), 3):
-        triplet = processed_df.iloc[i:i+3]
-        recomb_count = triplet['is_recombinant'].sum()
-        
-        if recomb_count == 1:
-            rows_to_keep.extend([i, i+1, i+2])
-        else:
-            stats['removed_triplets'] += 1
-            print(f"Removing triplet at rows {i}-{i+2}: {recomb_count} recombinants found, in files {rdpFiles[0]} & {rdpFiles[1]}")
-    
-    cleaned_df = processed_df.iloc[rows_to_keep].copy()
-    stats['remaining_triplets'] = len(cleaned_df) // 3
+    rejected = pd.DataFrame({'first_row': first_rows[~keep], 'recombinants': recomb_counts[~keep]})
+    if len(rejected):
+        found = ', '.join(f'{n} with {count} recombinants' for count, n in rejected['recombinants'].value_counts().sort_index().items())
+        files = f", in files {rdpFiles[0]} & {rdpFiles[1]}" if rdpFiles is not None else ''
+        print(f"Removing {len(rejected)} triplets: {found}{files}")
     
+    if report:
+        return cleaned_df, stats, rejected
     return cleaned_df, stats
 
 
@@ -133,47 +177,149 @@ def process_recombination_data(recomb_stats_path, sim_compare_path):
     recomb_stats.drop(["Event","StartBP", "EndBP"], axis = 1, inplace = True)
 
     # Create a new column to store the binary labels
-    recomb_stats['is_recombinant'] = 0
+    recomb_stats['is_recombinant'] = label_recombinants(recomb_stats['ISeqs(A)'], sim_compare['ActualRecomb'])
+
+    return recomb_stats
+
+def label_recombinants(iseqs, actual_recomb):
+    """
+    Label every row of RecombIdentifyStats with whether its ISeqs(A) holds the actual recombinant.
+    Row 3i, 3i+1 and 3i+2 form triplet i, which is row i of SimVSRealCompare.
     
-    # Process data in triplets
-    for i in range(0, len(sim_compare)):
-        # Get the actual recombinant ID for this triplet
-        actual_recomb = sim_compare.iloc[i]['ActualRecomb']
-        
-        # Get the corresponding three rows from recomb_stats
-        start_idx = i * 3
-        for j in range(3):  # Process each row in the triplet
-            current_idx = start_idx + j
-            
-            if current_idx >= len(recomb_stats):
-                print(f"Warning: Reached end of recomb_stats at index {current_idx}")
-                break
-                
-            # Get the sequence IDs from ISeqs(A)
-            if pd.isna(recomb_stats.iloc[current_idx]['ISeqs(A)']):
-                continue
-                
-            seq_ids = str(recomb_stats.iloc[current_idx]['ISeqs(A)']).split('$')
-            seq_ids = [int(id_) for id_ in seq_ids if id_.strip()]
-            
-            # Check if the actual recombinant is in this sequence
-            if actual_recomb in seq_ids:
-                recomb_stats.at[current_idx, 'is_recombinant'] = 1
+    Parameters:
+    iseqs (pandas.Series): The '$' separated sequence ids of every row, NaN where there are none
+    actual_recomb (pandas.Series): The actual recombinant of every triplet
+    
+    Returns:
+    numpy.ndarray: 1 for the rows holding the actual recombinant of their triplet, 0 otherwise
+    """
+    labels = np.zeros(len(iseqs), dtype=np.int64)
+    
+    # Triplets without all three rows in recomb_stats
+    for i in range(len(iseqs) // 3, len(actual_recomb)):
+        print(f"Warning: Reached end of recomb_stats at index {max(i * 3, len(iseqs))}")
+    
+    # One entry per (row, sequence id), rows past the last triplet are never labelled
+    rows = min(len(iseqs), 3 * len(actual_recomb))
+    ids = iseqs.iloc[:rows].reset_index(drop=True).dropna().astype(str).str.split('$').explode()
+    ids = ids[ids.str.strip() != '']
+    if ids.empty:
+        return labels
+    
+    # Line the actual recombinant of each triplet up with its three rows and compare
+    row_of_id = ids.index.to_numpy()
+    actual_of_row = np.repeat(actual_recomb.to_numpy(), 3)[:rows]
+    is_actual = ids.to_numpy().astype(np.int64) == actual_of_row[row_of_id]
+    labels[row_of_id[is_actual]] = 1
+    
+    return labels
+
+class ColumnarWriter:
+    """
+    Streams DataFrames into one Parquet (row group per frame) or Feather file.
+    Every column but is_recombinant is written as float64, since pandas reads a statistic as int64 in a file
+    where it happens to be all whole numbers, so the schema of the first frame fits every later one.
+    
+    Parameters:
+    output_path (Path): File to write, replaced if it exists
+    file_format (str): 'parquet' or 'feather'
+    """
+    
+    def __init__(self, output_path, file_format='parquet'):
+        if pyarrow is None:
+            raise ImportError(f"Writing {file_format} needs pyarrow, e.g. pip install pyarrow")
+        if file_format not in ('parquet', 'feather'):
+            raise ValueError(f"Unknown columnar format {file_format}, expected parquet or feather")
+        self.output_path = Path(output_path)
+        self.file_format = file_format
+        self.writer = None
+        self.schema = None
+    
+    def write(self, df):
+        statistics = [column for column in df.columns if column != 'is_recombinant']
+        df = df.astype({column: 'float64' for column in statistics})
+        table = pyarrow.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        if self.writer is None:
+            self.schema = table.schema
+            os.makedirs(self.output_path.parent, exist_ok=True)
+            if self.file_format == 'parquet':
+                self.writer = pyarrow.parquet.ParquetWriter(self.output_path, table.schema)
             else:
-                recomb_stats.at[current_idx, 'is_recombinant'] = 0
+                # Feather v2 is the Arrow IPC file format, so it can be written a record batch at a time
+                self.writer = pyarrow.ipc.new_file(self.output_path, table.schema)
+        self.writer.write_table(table)
+    
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
 
-    return recomb_stats
+def parse_files(rdpFiles):
+    """
+    Label and clean one pair of RDP5 outputs, run in the worker processes of parallel_parsing_loop.
+    
+    Parameters:
+    rdpFiles (tuple): (RecombIdentifyStats path, SimVSRealCompare path)
+    
+    Returns:
+    pandas.DataFrame: The cleaned data without ISeqs(A), the rows written to the dataset
+    dict: Statistics about the cleaning process
+    """
+    processed_data = process_recombination_data(rdpFiles[0], rdpFiles[1])
+    cleaned_data, cleaning_stats = validate_and_clean_triplets(processed_data, rdpFiles)
+    cleaned_data.drop(["ISeqs(A)"], axis = 1, inplace = True)
+    return cleaned_data, cleaning_stats
+
+def parallel_parsing_loop(output_path, workers=None, columnar=None):
+    """
+    Parse every pair of RDP5 outputs in a process pool. The results come back in the order of the pairs
+    and are appended by this process alone, to the legacy output_path and optionally to a columnar copy
+    next to it with the same name.
+    
+    Parameters:
+    output_path (Path): The ml_input text file, appended to like parsing_loop does
+    workers (int): Worker processes, default one per core
+    columnar (str): None, 'parquet' or 'feather'
+    
+    Returns:
+    dict: Statistics about the cleaning process summed over every pair
+    """
+    pairs, unpaired = pairFiles(rdpStatsFiles, rdpSimVReal)
+    for path in unpaired:
+        print(f"No matching RDP5 output for {path}, skipped")
+    
+    output_path = Path(output_path)
+    os.makedirs(output_path.parent, exist_ok=True)
+    writer = ColumnarWriter(output_path.with_suffix('.' + columnar), columnar) if columnar else None
+    totals = dict.fromkeys(['original_triplets', 'removed_triplets', 'remaining_triplets'], 0)
+    try:
+        with Pool(workers) as p:
+            for count, (cleaned_data, cleaning_stats) in enumerate(p.imap(parse_files, pairs), 1):
+                print(f'Parsed {count} out of {len(pairs)}: {pairs[count-1][0].name}, '
+                      f"{cleaning_stats['remaining_triplets']} of {cleaning_stats['original_triplets']} triplets kept.")
+                save_processed_data(cleaned_data, output_path)
+                if writer is not None:
+                    writer.write(cleaned_data)
+                for name in totals:
+                    totals[name] += cleaning_stats[name]
+    finally:
+        if writer is not None:
+            writer.close()
+    
+    print(f"Original number of triplets: {totals['original_triplets']}")
+    print(f"Removed triplets: {totals['removed_triplets']}")
+    print(f"Remaining triplets: {totals['remaining_triplets']}")
+    return totals
 
 def parsing_loop():
-    #Does len of recombIdent == SimVCompare?
-    total = len(rdpStatsFiles)
-    if len(rdpStatsFiles) != len(rdpSimVReal):
-        print("The number of files in the recombination event folder does not match the number of files in the sequence event folder")
-        print(f"Recombination event files: {total}")
-        print(f"Sequence event files: {len(rdpSimVReal)}")
-        return
-
-    for count, rdpFiles in enumerate(zip(rdpStatsFiles,rdpSimVReal)):
+    # Pairs are matched on their file names, see pairFiles
+    pairs, unpaired = pairFiles(rdpStatsFiles, rdpSimVReal)
+    total = len(pairs)
+    if unpaired:
+        print("Some RDP5 outputs have no matching file and are skipped:")
+        for path in unpaired:
+            print(path)
+
+    for count, rdpFiles in enumerate(pairs):
         # key = re.search(r'(?<=alignment_).*', alig.name).group()[:-3]
 
         if rdpFiles[0].exists():
@@ -203,6 +349,9 @@ def parsing_loop():
 if __name__ == '__main__':
     argParser = argparse.ArgumentParser(description='Process RDP5 files')
     argParser.add_argument('-f', dest='folder', help='file path to parse')
+    argParser.add_argument('-w', dest='workers', type=int, default=1, help='worker processes, more than 1 parses the files in parallel')
+    argParser.add_argument('-c', dest='columnar', choices=['parquet', 'feather'], default=None,
+                           help='also write the dataset as a columnar file next to the text file')
     args = argParser.parse_args()
 
     global folder
@@ -210,7 +359,10 @@ if __name__ == '__main__':
 
     # Change the path below to your target path.
     getFileNames(folderToParse=Path(folder))
-    parsing_loop()
+    if args.workers > 1 or args.columnar:
+        parallel_parsing_loop(Path(f"output_test/ml_input_{folder.name}.txt"), workers=args.workers, columnar=args.columnar)
+    else:
+        parsing_loop()
 
 # folder = Path('output_test')
 # rdpStatsFiles = [Path('dataRaw/UnseenTestSet/alignment_TestSet_3500-0.075-0.000118-200.faRecombIdentifyStats.csv')]
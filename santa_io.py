@@ -0,0 +1,63 @@
+# Readers for the recombination output files of the custom SANTA-SIM.
+# Both files are '*' delimited, the list columns are parsed straight into integer arrays instead of
+# running ast.literal_eval on every row.
+
+import collections
+import numpy as np
+import pandas as pd
+
+# Compressed sparse rows. keys[k] labels row k and the entries of row k are indices[indptr[k]:indptr[k+1]]
+CSR = collections.namedtuple('CSR', ['keys', 'indptr', 'indices'])
+
+def parse_int_lists(column):
+    # Parses a column of list strings such as '[1, 5, 9]', '{1, 5}', '[]' or 'set()' into (indptr, values) arrays
+    body = column.fillna('').str.strip('[]{}()set ')
+    counts = np.where(body.str.len().to_numpy() == 0, 0, body.str.count(',').to_numpy() + 1)
+
+    indptr = np.zeros(len(body) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+
+    joined = ','.join(body[counts > 0])
+    values = np.array(joined.split(','), dtype=np.int64) if joined else np.empty(0, dtype=np.int64)
+
+    return indptr, values
+
+def read_recombination_events(path):
+    # Reads a recombination_events file into a DataFrame of int64 columns: EventNum, Start, End, Generation
+    # rows keep the order of the file, Start and End are the two breakpoints of the event
+    rec_events = pd.read_csv(path, sep="*", usecols=["EventNum", "Breakpoints", "Generation"])
+
+    indptr, breakpoints = parse_int_lists(rec_events.Breakpoints)
+    if np.any(np.diff(indptr) != 2):
+        raise ValueError(f"Every event in {path} needs exactly two breakpoints")
+    breakpoints = breakpoints.reshape(-1, 2)
+
+    return pd.DataFrame({
+        "EventNum": rec_events.EventNum.to_numpy(dtype=np.int64),
+        "Start": breakpoints[:, 0],
+        "End": breakpoints[:, 1],
+        "Generation": rec_events.Generation.to_numpy(dtype=np.int64),
+    })
+
+def read_sequence_events_map(path):
+    # Reads a sequence_events_map file into a CSR of sequence -> events
+    # row k is sequence k+1 (the file lists the sequences in order), its entries are the event numbers it carries
+    seq_events = pd.read_csv(path, delimiter="*", usecols=["Events"], dtype=str)
+    indptr, events = parse_int_lists(seq_events.Events)
+
+    return CSR(np.arange(1, len(seq_events) + 1, dtype=np.int64), indptr, events)
+
+def invert_csr(csr):
+    # Inverts a CSR, e.g. sequence -> events into event -> sequences
+    # the new keys are the sorted unique entries, each row lists the old keys holding that entry in ascending order
+    counts = np.diff(csr.indptr)
+    owners = np.repeat(csr.keys, counts)
+
+    order = np.argsort(csr.indices, kind='stable')
+    keys, starts = np.unique(csr.indices[order], return_index=True)
+
+    indptr = np.empty(len(keys) + 1, dtype=np.int64)
+    indptr[:-1] = starts
+    indptr[-1] = len(order)
+
+    return CSR(keys, indptr, owners[order])
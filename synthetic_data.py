@@ -0,0 +1,128 @@
+# Synthetic SANTA-SIM-like fixtures, written in the file formats of the custom SANTA-SIM and of RDP5CL.
+# Used by benchmark.py to run the classifier and the parsers without the private datasets.
+# Everything is drawn from one seeded numpy Generator, so a (parameters, seed) pair always gives the same files.
+
+import os
+from pathlib import Path
+import numpy as np
+
+NUCLEOTIDES = np.frombuffer(b'ACGT', dtype=np.uint8)
+GAP = ord('-')
+
+def simulate(sequences=100, genome_length=3000, events=30, gap_density=0.01, seed=0):
+    # Simulates an alignment shaped by nested clades and recombination events
+    # returns (alignment, rec_events, seq_events):
+    # alignment [sequences x genome_length] uint8 byte codes, rec_events a list of (EventNum, start, end, Generation)
+    # in event order, seq_events a list with the sorted event numbers carried by each sequence
+    rng = np.random.default_rng(seed)
+    alignment = np.tile(rng.choice(NUCLEOTIDES, size=genome_length), (sequences, 1))
+
+    # clade structure: the population is split in halves, quarters, ... and every clade picks up its own mutations
+    # so sequences close in index are close in sequence, like the sampled tips of a tree
+    size = sequences
+    while size >= 1:
+        for lo in range(0, sequences, size):
+            sites = np.flatnonzero(rng.random(genome_length) < 0.01)
+            alignment[lo:lo+size, sites] = rng.choice(NUCLEOTIDES, size=len(sites))
+        size //= 2
+
+    # recombination: a clade of recombinants copies the region between two breakpoints from a donor outside it,
+    # later events are written over earlier ones, as in the generation matrix of the classifier
+    rec_events = []
+    seq_events = [[] for _ in range(sequences)]
+    for event in range(1, events + 1):
+        width = int(rng.integers(1, max(2, sequences // 20) + 1))
+        lo = int(rng.integers(0, sequences - width + 1))
+        donors = np.setdiff1d(np.arange(sequences), np.arange(lo, lo + width))
+        if len(donors) == 0:
+            break
+        donor = int(rng.choice(donors))
+        start, end = sorted(rng.choice(genome_length + 1, size=2, replace=False).tolist())
+
+        alignment[lo:lo+width, start:end] = alignment[donor, start:end]
+        rec_events.append((event, start, end, event * int(rng.integers(5, 20))))
+        for sequence in range(lo, lo + width):
+            seq_events[sequence].append(event)
+
+    # gaps: whole alignment columns (indels shared by everyone) and scattered single gaps
+    alignment[:, rng.random(genome_length) < gap_density / 2] = GAP
+    alignment[rng.random(alignment.shape) < gap_density / 2] = GAP
+
+    # SANTA-SIM writes breakpoints that run to the end of the genome as the ungapped length,
+    # the classifier maps those back to the alignment length
+    ungapped_length = genome_length - int(np.count_nonzero(alignment[0] == GAP))
+    rec_events = [(event, start, ungapped_length if end == genome_length else end, generation)
+                  for event, start, end, generation in rec_events]
+
+    return alignment, rec_events, seq_events
+
+def write_santa_files(folder, key, alignment, rec_events, seq_events):
+    # Writes alignment_<key>.fa, recombination_events_<key>.txt and sequence_events_map_<key>.txt
+    # returns their paths in that order
+    folder = Path(folder)
+    os.makedirs(folder, exist_ok=True)
+    alig = folder / ('alignment_' + key + '.fa')
+    rec = folder / ('recombination_events_' + key + '.txt')
+    seq = folder / ('sequence_events_map_' + key + '.txt')
+
+    with open(alig, 'wb') as f:
+        for row, sequence in enumerate(alignment):
+            f.write(b'>%d\n' % (row + 1) + sequence.tobytes() + b'\n')
+
+    with open(rec, 'w') as f:
+        f.write('EventNum*Breakpoints*Generation\n')
+        for event, start, end, generation in rec_events:
+            f.write(f'{event}*[{start}, {end}]*{generation}\n')
+
+    with open(seq, 'w') as f:
+        f.write('Sequence*Events\n')
+        for row, events in enumerate(seq_events):
+            f.write(f'{row + 1}*[{", ".join(str(e) for e in events)}]\n')
+
+    return alig, rec, seq
+
+def write_rdp_files(folder, key, triplets=1000, sequences=100, statistics=35, invalid=0.05, seed=0):
+    # Writes the two RDP5CL outputs read by output_parser: <alignment>.faRecombIdentifyStats.csv, three rows per
+    # detected event (one per sequence role) with '$' separated ISeqs(A) and the statistic columns, and
+    # <alignment>.faSimVSRealCompare.csv, one row per event naming the actual recombinant
+    # a share invalid of the triplets name the recombinant in two rows or in none, like the triplets output_parser drops
+    # headers are ', ' separated and rows ',' separated, empty fields are missing values
+    # returns (stats path, compare path)
+    rng = np.random.default_rng(seed)
+    folder = Path(folder)
+    os.makedirs(folder, exist_ok=True)
+    stats = folder / ('alignment_' + key + '.faRecombIdentifyStats.csv')
+    compare = folder / ('alignment_' + key + '.faSimVSRealCompare.csv')
+
+    columns = [f'Stat{s:02d}' for s in range(1, statistics + 1)]
+    values = rng.random((triplets * 3, statistics))
+    # some statistics are missing in RDP output, written as empty fields
+    values[rng.random(values.shape) < 0.02] = np.nan
+
+    actual = rng.integers(1, sequences + 1, size=triplets)
+    recombinant_row = rng.integers(0, 3, size=triplets)
+    broken = rng.random(triplets) < invalid
+
+    with open(stats, 'w') as s, open(compare, 'w') as c:
+        s.write(', '.join(['Event', 'StartBP', 'EndBP', 'ISeqs(A)'] + columns) + '\n')
+        c.write('Event, ActualRecomb, ActualStartBP, ActualEndBP\n')
+        others = np.arange(1, sequences + 1)
+        for t in range(triplets):
+            start = int(rng.integers(0, 5000))
+            end = start + int(rng.integers(50, 2000))
+            c.write(f'{t + 1},{actual[t]},{start},{end}\n')
+
+            holding = {int(recombinant_row[t])}
+            if broken[t]:
+                holding = {int(recombinant_row[t]), int(recombinant_row[t] + 1) % 3} if rng.random() < 0.5 else set()
+
+            for role in range(3):
+                ids = rng.choice(others[others != actual[t]], size=int(rng.integers(0, 4)), replace=False).tolist()
+                if role in holding:
+                    ids.insert(int(rng.integers(0, len(ids) + 1)), int(actual[t]))
+                iseqs = '$'.join(str(i) for i in ids) + ('$' if ids else '')
+
+                fields = ['' if np.isnan(v) else f'{v:.6f}' for v in values[t * 3 + role]]
+                s.write(','.join([str(t + 1), str(start), str(end), iseqs] + fields) + '\n')
+
+    return stats, compare
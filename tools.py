@@ -1,6 +1,8 @@
 # RDP Tensorflow Impl.
 import pandas as pd
+import json
 import numpy as np
+from pathlib import Path
 from sklearn.metrics import classification_report
 from collections import defaultdict
 
@@ -28,17 +30,36 @@ def ingestor(recom_path):
 
     return allData
 
-def combine_three_rows(input_file, output_file):
+def triplet_columns(columns):
+    """
+    Column names of the combine_three_rows output for a DataFrame with the given columns.
+    
+    Parameters:
+    columns (list): Columns of the input, including 'is_recombinant'
+    
+    Returns:
+    list: 'id', 'Recombinant1' to 'Recombinant3', then '{col}1', '{col}2', '{col}3' for every other column in order
+    """
+    features = [col for col in columns if col != 'is_recombinant']
+    return ['id', 'Recombinant1', 'Recombinant2', 'Recombinant3'] + [f'{col}{k}' for col in features for k in (1, 2, 3)]
+
+def combine_three_rows(input_file, output_file=None, as_array=False, columnar_file=None, chunk=100000):
     """
     Reads a CSV file and combines every three rows into one, renaming columns appropriately.
     Particularily used in the posistion selection NN to combine the original data into data that has all features from all viruses.
+    The rows are reshaped from [rows x features] to [triplets x 3 x features] and then to [triplets x features x 3],
+    so the three values of every column end up next to each other. Incomplete trailing triplets are dropped.
     
     Parameters:
     input_file (str): Path to the input CSV file or a Pandas DataFrame
-    output_file (str): Path to save the output CSV file
+    output_file (str): Path to save the output CSV file, no CSV is written without it
+    as_array (bool): Return the values as a numpy array instead of a DataFrame, the column names are given by triplet_columns
+    columnar_file (str): Path of a .npy file to write the values to a chunk of triplets at a time, returned as a read-only
+                         memory map, the column names are written next to it as <name>.columns.json
+    chunk (int): Triplets written to columnar_file at a time
     
     Returns:
-    pd.DataFrame: The transformed DataFrame
+    pd.DataFrame: The transformed DataFrame, a numpy array with as_array or a numpy memmap with columnar_file
     """
     # Read the CSV file
     if (type(input_file) == pd.DataFrame):
@@ -46,37 +67,49 @@ def combine_three_rows(input_file, output_file):
     else:
         df = pd.read_csv(input_file)
     
-    # Initialize lists to store the new rows
-    new_rows = []
-    
-    # Process rows in groups of three
-    for i in range(0, len(df), 3):
-        if i + 2 < len(df):  # Make sure we have 3 rows to combine
-            new_row = {}
-            new_row['id'] = i // 3  # Add an ID column
-            
-            # Add recombinant values
-            new_row['Recombinant1'] = df.iloc[i]['is_recombinant']
-            new_row['Recombinant2'] = df.iloc[i+1]['is_recombinant']
-            new_row['Recombinant3'] = df.iloc[i+2]['is_recombinant']
-            
-            # Process each column (except 'is_recombinant')
-            for col in df.columns:
-                if col != 'is_recombinant':
-                    # Add values for each of the three rows with numbered suffix
-                    new_row[f'{col}1'] = df.iloc[i][col]
-                    new_row[f'{col}2'] = df.iloc[i+1][col]
-                    new_row[f'{col}3'] = df.iloc[i+2][col]
-            
-            new_rows.append(new_row)
-    
-    # Create new DataFrame
-    result_df = pd.DataFrame(new_rows)
+    # The labels go first, so after the reshape they are Recombinant1 to Recombinant3
+    ordered = df[['is_recombinant'] + [col for col in df.columns if col != 'is_recombinant']]
+    n_triplets = len(df) // 3
+    n_values = 3 * ordered.shape[1]
+    columns = triplet_columns(df.columns)
+    
+    def combine(lo, hi):
+        # The combined values of triplets [lo, hi), with the values taking the common dtype of the columns like a row of df does
+        values = ordered.iloc[3*lo:3*hi].to_numpy()
+        values = values.reshape(hi - lo, 3, ordered.shape[1]).transpose(0, 2, 1).reshape(hi - lo, n_values)
+        return values
+    
+    if columnar_file is not None:
+        columnar_file = Path(columnar_file)
+        dtype = np.result_type(ordered.iloc[:0].to_numpy().dtype, np.int64)
+        if dtype == object:
+            raise ValueError("columnar_file needs numeric columns")
+        combined = np.lib.format.open_memmap(columnar_file, mode='w+', dtype=dtype, shape=(n_triplets, len(columns)))
+        for lo in range(0, n_triplets, chunk):
+            hi = min(lo + chunk, n_triplets)
+            combined[lo:hi, 0] = np.arange(lo, hi)
+            combined[lo:hi, 1:] = combine(lo, hi)
+        combined.flush()
+        del combined
+        columnar_file.with_suffix('.columns.json').write_text(json.dumps(columns))
+        return np.load(columnar_file, mmap_mode='r')
+    
+    values = combine(0, n_triplets)
+    if as_array and output_file is None:
+        return np.concatenate([np.arange(n_triplets, dtype=values.dtype)[:, None], values], axis=1)
+    
+    # Create new DataFrame, the columns get the dtypes a frame built from the rows would have
+    if n_triplets:
+        result_df = pd.DataFrame(values, columns=columns[1:]).infer_objects()
+        result_df.insert(0, 'id', np.arange(n_triplets, dtype=np.int64))
+    else:
+        result_df = pd.DataFrame()
     
     # Save to CSV
-    result_df.to_csv(output_file, index=False)
+    if output_file is not None:
+        result_df.to_csv(output_file, index=False)
     
-    return result_df
+    return result_df.to_numpy() if as_array else result_df
 
 
 